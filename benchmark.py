@@ -0,0 +1,1121 @@
+"""Micro-benchmarks for the traffic_jam tick loop.
+
+Run all benchmarks with `python benchmark.py`, or pick some by name,
+e.g. `python benchmark.py cues`.
+"""
+import os
+import sys
+import time
+import random
+import resource
+import shutil
+import argparse
+import tempfile
+import subprocess
+
+import yaml
+
+import traffic_jam
+
+
+def setup_globals(bpm=120, ppq=24, instrument=False):
+    traffic_jam.CLOCK = traffic_jam.Clock(bpm=bpm, ppq=ppq)
+    traffic_jam.NOTE_DB = traffic_jam.NoteDB("notes.yaml")
+    traffic_jam.PALETTE = traffic_jam.Palette("palette.yaml")
+    if instrument:
+        # Tick lateness is only measured on an instrumented clock
+        traffic_jam.CLOCK.instrument(traffic_jam.Metrics(traffic_jam.CLOCK, report_interval=None))
+    return traffic_jam.CLOCK
+
+
+def write_timeline(slices, pads_per_slice, slice_length=24, chord_size=1, seed=0):
+    """Writes a synthetic timeline and returns its filename.
+
+    Every slice sets `pads_per_slice` random pads to a random color, each playing
+    a chord of `chord_size` notes spelled with note names.
+    """
+    rng = random.Random(seed)
+    colors = list(yaml.full_load(open("palette.yaml"))["colors"])
+    notes = ["C", "D", "E", "F", "G", "A", "B"]
+
+    fd, filename = tempfile.mkstemp(suffix=".yaml", prefix="timeline_")
+    # Written by hand, yaml.dump is far too slow for timelines of this size
+    with os.fdopen(fd, "w") as f:
+        for i in range(slices):
+            f.write(f"{i * slice_length}:\n")
+            for pad in rng.sample(range(63), pads_per_slice):
+                chord = " ".join(f"{rng.choice(notes)}{rng.randrange(1, 6)}" for _ in range(chord_size))
+                color = rng.choice(colors)
+                f.write(f"  {pad}: {{led: {{active: {{color: {color}}}, inactive: {{color: {color}}}}}, "
+                        f"note: \"{chord}\"}}\n")
+    return filename
+
+
+class NullPort:
+    """Stands in for a mido port, counting what is sent to it."""
+
+    def __init__(self):
+        self.sent = 0
+
+    def send(self, message):
+        self.sent += 1
+
+    def send_bytes(self, data):
+        self.sent += 1
+
+    def close(self):
+        pass
+
+
+class Loopback:
+    """Mock backend sink that timestamps every frame sent to the relay port."""
+
+    def __init__(self):
+        self.received = []
+
+    def __call__(self, port_name, data):
+        if port_name == "relay":
+            self.received.append((time.perf_counter_ns(), bytes(data)))
+
+
+def make_jam(timeline=None, sink=None, **kwargs):
+    """Builds a `MaschineJam` on a mock backend instead of a real device."""
+    jam = traffic_jam.MaschineJam("device", "device", "relay", backend=traffic_jam.MockBackend(sink), **kwargs)
+    if timeline:
+        jam.activate_timeline(timeline)
+    return jam
+
+
+def report(name, value, unit):
+    print(f"  {name:<32} {value:>12.3f} {unit}")
+
+
+def allocated_per_tick(tick, count):
+    """Mean of the most memory allocated at once during each of `count` calls of `tick(i)`.
+
+    Unlike a snapshot diff this includes everything that was freed again before the
+    call returned, which is most of what a tick allocates.
+    """
+    import tracemalloc
+
+    total = 0
+    tracemalloc.start()
+    try:
+        for i in range(count):
+            # Forgets earlier blocks and resets the peak, so only this call is counted
+            tracemalloc.clear_traces()
+            tick(i)
+            total += tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return total / count
+
+
+### Benchmarks ###
+
+def bench_cues(ticks=5000):
+    """Per-tick cost of the cue scheduler with a growing number of pending cues."""
+    print("Cue scheduler: per-tick cost vs. pending cues")
+
+    def noop():
+        pass
+
+    for pending in (10, 100, 1000, 10000, 100000):
+        clock = setup_globals()
+        rng = random.Random(pending)
+        # Cues beyond the measured window stay pending for the whole run
+        for _ in range(pending):
+            clock.register_cue(ticks + rng.randrange(1, 1000000), noop)
+        # One recurring cue keeps the due path busy on every tick
+        clock.register_cue(0, noop, every=1)
+
+        start = time.perf_counter()
+        for _ in range(ticks):
+            clock.cues.run_due(clock.tick_no)
+            clock.tick_no += 1
+        elapsed = time.perf_counter() - start
+
+        report(f"{pending} pending", elapsed / ticks * 1e6, "us/tick")
+
+
+def bench_offline(bpm=120, ppq=24):
+    """Offline render of a 10 minute show through the mock backend."""
+    print(f"Offline render: 10 minute show at {bpm} BPM / {ppq} PPQ")
+    clock = setup_globals(bpm, ppq)
+    filename = write_timeline(10 * bpm, 16, ppq)
+    try:
+        timeline = traffic_jam.Timeline(filename, cache=False)
+    finally:
+        os.remove(filename)
+
+    start = time.perf_counter()
+    traffic_jam.render(timeline, os.devnull, ticks=10 * 60 * bpm * ppq // 60)
+    report("render time", time.perf_counter() - start, "s")
+    report("clock ticks", clock.tick_no, "ticks")
+
+
+def bench_profile(ticks=20000, stall_every=500, stall_time=0.002, budget=0.001):
+    """Overhead of the per-object tick profiler and trace file, and whether it names a stalling object."""
+    import io
+    import json
+    import contextlib
+
+    print(f"Tick profiler: snake.yaml and clock output for {ticks} ticks")
+
+    def run(profile, trace_file=None):
+        clock = setup_globals()
+        clock.unlock()
+        timeline = traffic_jam.Timeline("timelines/snake.yaml", cache=False)
+        clock.register(traffic_jam.ClockOutput(clock, NullPort().send_bytes), name="clock output")
+        clock.register(make_jam(timeline), name="jam")
+        profiler = None
+        if profile:
+            profiler = traffic_jam.Profiler(clock, trace_file=trace_file)
+            clock.profile(profiler)
+        start = time.perf_counter()
+        for _ in range(ticks):
+            clock.tick()
+            clock.tick_no += 1
+        elapsed = time.perf_counter() - start
+        if profiler:
+            profiler.close()
+        return elapsed / ticks
+
+    fd, trace_file = tempfile.mkstemp(suffix=".json", prefix="trace_")
+    os.close(fd)
+    try:
+        plain = run(False)
+        report("tick, not profiled", plain * 1e6, "us")
+        report("tick, profiled", run(True) * 1e6, "us")
+        report("tick, profiled with trace", run(True, trace_file) * 1e6, "us")
+        with open(trace_file) as f:
+            events = json.load(f)
+        report("trace size", os.path.getsize(trace_file) / ticks, "bytes/tick")
+        print(f"    trace events: {len(events)}, valid JSON")
+    finally:
+        os.remove(trace_file)
+
+    class Stall(traffic_jam.Tickable):
+        """Blocks for `stall_time` every `stall_every` ticks."""
+
+        def tick(self, tick_no):
+            if tick_no % stall_every == stall_every - 1:
+                time.sleep(stall_time)
+
+    clock = setup_globals()
+    clock.unlock()
+    clock.register(make_jam(traffic_jam.Timeline("timelines/snake.yaml", cache=False)), name="jam")
+    clock.register(Stall(), name="stall")
+    profiler = traffic_jam.Profiler(clock, budget=budget)
+    clock.profile(profiler)
+    log = io.StringIO()
+    with contextlib.redirect_stdout(log):
+        for _ in range(ticks // 4):
+            clock.tick()
+            clock.tick_no += 1
+    lines = log.getvalue().splitlines()
+    print(f"  [budget {budget * 1e3:.1f} ms, stalling {stall_time * 1e3:.1f} ms every {stall_every} ticks]")
+    report("ticks over budget", profiler.over_budget, "ticks")
+    report("expected", ticks // 4 // stall_every, "ticks")
+    print(f"    offender named in every log line: {all('Slowest: stall' in line for line in lines)}")
+    print(f"    first: {lines[0] if lines else None}")
+
+
+def bench_render(ticks=2000):
+    """Controls visited per tick by `MaschineJam.tick`, idle and while playing a timeline."""
+    print("Render pass: controls visited per tick")
+
+    for name, filename in (("idle", None), ("snake.yaml", "timelines/snake.yaml")):
+        clock = setup_globals()
+        clock.unlock()
+        jam = make_jam(traffic_jam.Timeline(filename, cache=False) if filename else None, instrument=True)
+        clock.register(jam)
+        # The first tick paints the whole device
+        jam.tick(clock.tick_no)
+
+        visited = worst = 0
+        start = time.perf_counter()
+        for tick_no in range(1, ticks + 1):
+            jam.tick(tick_no)
+            visited += jam.visited
+            worst = max(worst, jam.visited)
+        elapsed = time.perf_counter() - start
+
+        report(f"{name} avg visited", visited / ticks, "controls/tick")
+        report(f"{name} max visited", worst, "controls/tick")
+        report(f"{name} tick time", elapsed / ticks * 1e6, "us/tick")
+        if jam.timeline:
+            transitions = jam.timeline.transitions
+            report(f"{name} changes per slice", sum(map(len, transitions)) / len(transitions), "controls")
+        report(f"{name} LED frames sent", jam.leds.sent, "frames")
+        report(f"{name} LED frames dropped", jam.leds.dropped, "frames")
+
+
+def bench_sends(sends=200000):
+    """LED + relay sends per second, building `mido.Message`s vs. sending precompiled frames."""
+    print("MIDI sends: mido.Message construction vs. precompiled frames")
+    setup_globals()
+    port = NullPort()
+    import mido
+    led_state = traffic_jam.LedState("orange", "bright")
+    note_output = (60, 64, 67)
+
+    def send_messages():
+        for i in range(sends // 4):
+            note = i % 64
+            port.send(mido.Message("note_on", note=note, velocity=led_state.color_value()))
+            for output in note_output:
+                port.send(mido.Message("note_on", channel=0, note=output, velocity=127))
+
+    button = traffic_jam.Button(port, port, 0, led_state_active=led_state, note_output=note_output)
+    button.state = traffic_jam.ButtonState.ACTIVE
+    frames = [traffic_jam.Button.compile_frames(note, led_state, led_state, note_output) for note in range(64)]
+
+    def send_frames():
+        send = button.send_device
+        for i in range(sends // 4):
+            device_frame, relay_frames = frames[i % 64][button.state]
+            send(device_frame)
+            for frame in relay_frames:
+                send(frame)
+
+    for name, func in (("mido.Message", send_messages), ("precompiled frames", send_frames)):
+        start = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - start
+        report(name, sends / elapsed / 1000, "k sends/s")
+
+
+def bench_clock(seconds=2.0, bpm=120, ppq=96):
+    """Tick lateness of `Clock.once` in real time, with a stall halfway through."""
+    print(f"Clock engine: tick lateness at {bpm} BPM / {ppq} PPQ over {seconds:.1f}s")
+
+    class Stall(traffic_jam.Tickable):
+
+        def __init__(self, tick_no, duration):
+            self.tick_no = tick_no
+            self.duration = duration
+
+        def tick(self, tick_no):
+            if tick_no == self.tick_no:
+                time.sleep(self.duration)
+
+    for policy in traffic_jam.Clock.LATE_POLICIES:
+        setup_globals()
+        clock = traffic_jam.Clock(bpm=bpm, ppq=ppq, late_policy=policy)
+        clock.instrument(traffic_jam.Metrics(clock, report_interval=None))
+        traffic_jam.CLOCK = clock
+        ticks = int(seconds / clock.tick_length)
+        clock.register(Stall(ticks // 2, clock.tick_length * 4.5))
+
+        start = time.perf_counter()
+        while clock.pulse < ticks:
+            clock.once()
+        elapsed = time.perf_counter() - start
+
+        summary = clock.jitter.summary()
+        report(f"{policy} p50 lateness", summary["p50"], "ms")
+        report(f"{policy} p99 lateness", summary["p99"], "ms")
+        report(f"{policy} drift", (elapsed - seconds) * 1000, "ms")
+        report(f"{policy} ticks played", clock.tick_no, "ticks")
+
+
+def bench_latency(presses=100, bpm=120, ppq=24):
+    """Press-to-relay latency through a running clock thread, tick-quantized vs. immediate relaying."""
+    print(f"Press-to-relay latency at {bpm} BPM / {ppq} PPQ")
+    import mido
+    rng = random.Random(0)
+
+    for immediate in (False, True):
+        clock = setup_globals(bpm, ppq)
+        clock.unlock()
+        loopback = Loopback()
+        jam = make_jam(sink=loopback, immediate_relay=immediate)
+        for note, button in jam.grid.items():
+            button.configure(note_output=note + 36)
+        clock.register(jam)
+        clock_thread = traffic_jam.ClockThread(clock)
+        clock_thread.start()
+
+        # Let the initial repaint go out before measuring
+        time.sleep(0.1)
+        latency = traffic_jam.LatencyStats()
+        relay = loopback
+        for i in range(presses):
+            note = rng.randrange(63)
+            velocity = 127 if i % 2 == 0 else 0
+            expected = bytes((traffic_jam.NOTE_ON, note + 36, velocity))
+            relay.received.clear()
+            sent = time.perf_counter_ns()
+            jam.port_in.send(mido.Message("note_on", note=note, velocity=velocity))
+            while not any(frame == expected for _, frame in relay.received):
+                time.sleep(0.0001)
+            arrived = next(timestamp for timestamp, frame in relay.received if frame == expected)
+            latency.record(arrived - sent)
+            # Land the next press at a random point within the tick grid
+            time.sleep(rng.uniform(0, clock.tick_length))
+
+        clock_thread.stop()
+        summary = latency.summary()
+        mode = "immediate" if immediate else "tick"
+        report(f"{mode} p50 latency", summary["p50"], "ms")
+        report(f"{mode} p99 latency", summary["p99"], "ms")
+        report(f"{mode} max latency", summary["max"], "ms")
+
+
+def bench_seek(seeks=200, bpm=120, ppq=24):
+    """Seeking across a 10 minute show, from `Clock.seek` to the rendered state."""
+    slice_length = ppq
+    slices = 10 * bpm
+    print(f"Seek: {slices} slices over 10 minutes at {bpm} BPM / {ppq} PPQ")
+
+    clock = setup_globals(bpm, ppq)
+    clock.unlock()
+    filename = write_timeline(slices, 16, slice_length)
+    try:
+        jam = make_jam(traffic_jam.Timeline(filename, cache=False))
+    finally:
+        os.remove(filename)
+    clock.register(jam)
+    jam.tick(clock.tick_no)
+
+    rng = random.Random(0)
+    show_length = slices * slice_length
+    worst = total = 0
+    for _ in range(seeks):
+        start = time.perf_counter()
+        clock.seek(rng.randrange(show_length))
+        jam.tick(clock.tick_no)
+        elapsed = time.perf_counter() - start
+        total += elapsed
+        worst = max(worst, elapsed)
+
+    report("avg seek", total / seeks * 1000, "ms")
+    report("worst seek", worst * 1000, "ms")
+
+
+def bench_tick(ticks=20000):
+    """Cost of ticking controls whose state changed, the inner loop of every repaint."""
+    print("Control tick: all 88 controls changing state every tick")
+
+    setup_globals()
+    jam = make_jam()
+    for note, button in jam.grid.items():
+        button.configure(note_output=(note + 36, note + 40))
+    # Leave out the transport actions, they would pause and warp the clock
+    for button in jam.special_buttons.values():
+        button.action = None
+    controls = list(jam.controls())
+    jam.tick(0)
+
+    def run(first, count):
+        for tick_no in range(first, first + count):
+            state = tick_no % 2
+            for control in controls:
+                control.state = state if not isinstance(control, traffic_jam.TouchStrip) else tick_no % 128
+                control.tick(tick_no)
+
+    start = time.perf_counter()
+    run(0, ticks)
+    elapsed = time.perf_counter() - start
+
+    allocated = allocated_per_tick(lambda i: run(ticks + i, 1), 100)
+
+    report("per control tick", elapsed / ticks / len(controls) * 1e9, "ns")
+    report("per full repaint", elapsed / ticks * 1e6, "us")
+    report("peak allocated per repaint", allocated, "bytes")
+    report("memory per control", sum(sys.getsizeof(control) + sys.getsizeof(getattr(control, "__dict__", None))
+                                     for control in controls) / len(controls), "bytes")
+
+
+def bench_metrics(ticks=50000):
+    """Per-tick cost of `Clock.tick` with and without instrumentation."""
+    print("Instrumentation: Clock.tick overhead")
+    for name, instrument in (("off", False), ("on", True)):
+        clock = setup_globals()
+        clock.unlock()
+        clock.register(make_jam(instrument=instrument))
+        if instrument:
+            clock.instrument(traffic_jam.Metrics(clock, report_interval=3600))
+        start = time.perf_counter()
+        for _ in range(ticks):
+            clock.tick()
+        elapsed = time.perf_counter() - start
+        report(f"metrics {name}", elapsed / ticks * 1e6, "us/tick")
+
+
+def bench_suite(scale=1.0, cues=10000):
+    """Tick loop throughput on synthetic timelines: long, dense, chord-heavy and cue-heavy shows."""
+    scenarios = [
+        # name, slices, pads per slice, chord size, cues
+        ("long", 2000, 4, 1, 0),
+        ("dense", 250, 63, 1, 0),
+        ("chords", 250, 63, 4, 0),
+        ("cues", 250, 63, 1, cues),
+    ]
+    print(f"Tick loop suite (scale {scale})")
+
+    for name, slices, pads, chord_size, cue_count in scenarios:
+        slices = max(int(slices * scale), 1)
+        cue_count = int(cue_count * scale)
+        clock = setup_globals()
+        clock.unlock()
+        # A new slice every other tick keeps the whole render path busy
+        slice_length = 2
+        filename = write_timeline(slices, pads, slice_length, chord_size)
+        timeline = None
+        try:
+            start = time.perf_counter()
+            timeline = traffic_jam.Timeline(filename)
+            load_time = time.perf_counter() - start
+            # The second load comes from the compiled cache written by the first one
+            start = time.perf_counter()
+            timeline = traffic_jam.Timeline(filename)
+            cached_load_time = time.perf_counter() - start
+        finally:
+            os.remove(filename)
+            # Unset if the first load failed, which then did not write a cache either
+            if timeline is not None and os.path.exists(timeline.cache_path):
+                os.remove(timeline.cache_path)
+
+        jam = make_jam(timeline)
+        clock.register(jam)
+        rng = random.Random(0)
+        ticks = slices * slice_length
+        for _ in range(cue_count):
+            clock.register_cue(rng.randrange(ticks), lambda: None)
+
+        worst = 0
+        start = time.perf_counter()
+        for _ in range(ticks):
+            tick_start = time.perf_counter_ns()
+            clock.tick()
+            clock.tick_no += 1
+            worst = max(worst, time.perf_counter_ns() - tick_start)
+        elapsed = time.perf_counter() - start
+
+        # Replay the show with allocation tracing, separately so it does not skew the timings
+        clock.seek(0)
+        jam.activate_timeline(timeline)
+
+        def tick(_):
+            clock.tick()
+            clock.tick_no += 1
+
+        allocated = allocated_per_tick(tick, ticks)
+
+        print(f"  [{name}] {slices} slices, {pads} pads/slice, {chord_size} notes/pad, {cue_count} cues")
+        report("timeline load", load_time * 1000, "ms")
+        report("timeline load (cached)", cached_load_time * 1000, "ms")
+        report("ticks per second", ticks / elapsed, "ticks/s")
+        report("mean tick", elapsed / ticks * 1e6, "us")
+        report("worst tick", worst / 1e3, "us")
+        report("peak allocated per tick", allocated, "bytes")
+
+
+def bench_sync(seconds=4.0, ppq=96, delay=0.5):
+    """Following an external MIDI clock with jittery delivery, a tempo change halfway and a song position jump."""
+    import mido
+
+    print(f"External clock: 24 PPQ master to {ppq} PPQ, up to {delay * 3:.1f} ms delivery delay")
+    setup_globals(ppq=ppq)
+    clock = traffic_jam.ExternalClock(bpm=120, ppq=ppq)
+    traffic_jam.CLOCK = clock
+    port = traffic_jam.MockInput("clock")
+    clock.attach(port)
+    rng = random.Random(0)
+
+    class Recorder(traffic_jam.Tickable):
+
+        def __init__(self):
+            self.ticks = []
+
+        def tick(self, tick_no):
+            if not clock.locked:
+                self.ticks.append((time.perf_counter_ns(), tick_no))
+
+    recorder = Recorder()
+    clock.register(recorder)
+    clock_thread = traffic_jam.ClockThread(clock)
+    clock_thread.start()
+
+    # The master plays at 120 BPM, then jumps to 140 BPM halfway through
+    grid = []
+    start = time.perf_counter_ns() + 50_000_000
+    clocks = int(seconds / 2 * 2 * 24)
+    for i in range(clocks):
+        grid.append(start + i * round(60e9 / (120 * 24)))
+    for i in range(1, clocks + 1):
+        grid.append(grid[clocks - 1] + i * round(60e9 / (140 * 24)))
+
+    def send_at(when, message):
+        time.sleep(max(when - time.perf_counter_ns(), 0) / 1e9)
+        port.send(message)
+
+    send_at(start - 10_000_000, mido.Message("start"))
+    for when in grid:
+        # USB and driver latency only ever delays messages
+        send_at(when + abs(rng.gauss(0, delay)) * 1e6, mido.Message("clock"))
+    time.sleep(0.05)
+
+    def ideal(tick_no):
+        position = tick_no * 24 / ppq
+        i = min(int(position), len(grid) - 2)
+        return grid[i] + (position - i) * (grid[i + 1] - grid[i])
+
+    # Skip the first beat, the loop needs a few clocks to settle
+    settled = [(stamp, tick_no) for stamp, tick_no in recorder.ticks if tick_no >= ppq]
+    for name, low, high in (("120 BPM", ppq, clocks * ppq // 24),
+                            ("140 BPM", (clocks + 24) * ppq // 24, 2 * clocks * ppq // 24)):
+        errors = traffic_jam.LatencyStats()
+        for stamp, tick_no in settled:
+            if low <= tick_no < high:
+                errors.record(abs(round(stamp - ideal(tick_no))))
+        summary = errors.summary()
+        report(f"{name} p50 tick error", summary["p50"], "ms")
+        report(f"{name} p99 tick error", summary["p99"], "ms")
+    report("estimated tempo (140 BPM)", clock.tempo, "BPM")
+    tick_numbers = [tick_no for _, tick_no in recorder.ticks]
+    report("ticks missing or repeated", len(set(range(max(tick_numbers) + 1)) ^ set(tick_numbers)) +
+           len(tick_numbers) - len(set(tick_numbers)), "ticks")
+
+    # Jump to bar 5 while stopped, the first tick after continuing must land right there
+    port.send(mido.Message("stop"))
+    port.send(mido.Message("songpos", pos=64))
+    recorder.ticks.clear()
+    port.send(mido.Message("continue"))
+    for _ in range(4):
+        time.sleep(60 / (140 * 24))
+        port.send(mido.Message("clock"))
+    time.sleep(0.05)
+    clock_thread.stop()
+    report("song position 64 landed on tick", recorder.ticks[0][1], f"(expected {64 * 6 * ppq // 24})")
+    report("incoming clock jitter p50", clock.sync_error.percentile(0.5) / 1e6, "ms")
+
+
+def bench_clock_out(seconds=2.0, bpm=120, ppq=96):
+    """Jitter of the MIDI clock output, idle and while rendering a dense timeline."""
+    print(f"MIDI clock output at {bpm} BPM / {ppq} PPQ over {seconds:.1f}s")
+
+    for name, slices in (("idle", 0), ("dense", 100)):
+        clock = setup_globals(bpm, ppq, instrument=True)
+        clock.unlock()
+        loopback = Loopback()
+        filename = write_timeline(slices, 63, 2) if slices else None
+        try:
+            jam = make_jam(traffic_jam.Timeline(filename, cache=False) if filename else None, sink=loopback)
+        finally:
+            if filename:
+                os.remove(filename)
+        output = traffic_jam.ClockOutput(clock, jam.send_relay)
+        clock.register(output)
+        clock.register(jam)
+        clock_thread = traffic_jam.ClockThread(clock)
+        clock_thread.start()
+        time.sleep(seconds)
+        clock_thread.stop()
+
+        # What a receiver sees, measured at the port rather than by the clock itself
+        stamps = [stamp for stamp, frame in loopback.received if frame == output.CLOCK_FRAME]
+        intervals = sorted(abs(b - a - 60e9 / (bpm * 24)) for a, b in zip(stamps, stamps[1:]))
+        report(f"{name} lateness p50", output.lateness.percentile(0.5) / 1e6, "ms")
+        report(f"{name} lateness p99", output.lateness.percentile(0.99) / 1e6, "ms")
+        report(f"{name} interval error p50", intervals[len(intervals) // 2] / 1e6, "ms")
+        report(f"{name} interval error p99", intervals[int(len(intervals) * 0.99)] / 1e6, "ms")
+        report(f"{name} clocks sent", output.sent, f"(expected {seconds * bpm / 60 * 24:.0f})")
+
+
+def bench_runtime(seconds=2.0, bpm=120, ppq=96):
+    """Tick lateness and input latency of the threaded clock vs. the asyncio runner."""
+    import asyncio
+    import threading
+    import mido
+
+    print(f"Runtime: clock thread vs. asyncio loop at {bpm} BPM / {ppq} PPQ over {seconds:.1f}s")
+
+    async def chatter():
+        # Stands in for other I/O on the loop, e.g. an OSC server handling a message every 2 ms
+        while True:
+            await asyncio.sleep(0.002)
+            end = time.perf_counter_ns() + 100_000
+            while time.perf_counter_ns() < end:
+                pass
+
+    async def run_async(runner, busy):
+        tasks = [asyncio.create_task(runner.run())]
+        if busy:
+            tasks.append(asyncio.create_task(chatter()))
+        await asyncio.sleep(seconds)
+        runner.stop()
+        await tasks[0]
+        for task in tasks[1:]:
+            task.cancel()
+
+    for mode in ("thread", "asyncio", "asyncio+busy"):
+        clock = setup_globals(bpm, ppq, instrument=True)
+        clock.unlock()
+        jam = make_jam(traffic_jam.Timeline("timelines/snake.yaml", cache=False), instrument=True)
+        clock.register(jam)
+
+        def press():
+            rng = random.Random(0)
+            end = time.perf_counter() + seconds - 0.1
+            while time.perf_counter() < end:
+                time.sleep(rng.uniform(0.005, 0.02))
+                jam.port_in.send(mido.Message("note_on", note=rng.randrange(63), velocity=rng.choice((0, 127))))
+
+        presser = threading.Thread(target=press)
+        if mode == "thread":
+            clock_thread = traffic_jam.ClockThread(clock)
+            clock_thread.start()
+            presser.start()
+            time.sleep(seconds)
+            clock_thread.stop()
+        else:
+            runner = traffic_jam.AsyncRunner(clock)
+            runner.bridge(jam.port_in, jam.process_message)
+            presser.start()
+            asyncio.run(run_async(runner, mode.endswith("busy")))
+        presser.join()
+
+        summary = clock.jitter.summary()
+        report(f"{mode} p50 lateness", summary["p50"], "ms")
+        report(f"{mode} p99 lateness", summary["p99"], "ms")
+        report(f"{mode} max lateness", summary["max"], "ms")
+        report(f"{mode} input to LED p50", jam.input_latency.summary()["p50"], "ms")
+
+
+def bench_devices(ticks=200, write_time=0.0001):
+    """Two devices on one clock, one repainting its whole grid, with writes that block like a USB device."""
+    print(f"Multiple devices: {write_time * 1e3:.1f} ms per device write")
+    filename = write_timeline(ticks // 2, 63, 2)
+
+    def slow_device(port_name, data):
+        if "device" in port_name:
+            time.sleep(write_time)
+
+    class Probe(traffic_jam.Tickable):
+        """Records when the tick of the second device starts, relative to the start of the clock tick."""
+
+        def __init__(self, clock_tick):
+            self.clock_tick = clock_tick
+            self.delays = []
+
+        def tick(self, tick_no):
+            self.delays.append(time.perf_counter_ns() - self.clock_tick[0])
+
+    try:
+        for send_thread in (False, True):
+            # Like main() does whenever it drives more than one device
+            switch_interval = sys.getswitchinterval()
+            if send_thread:
+                sys.setswitchinterval(0.0005)
+            clock = setup_globals()
+            clock.unlock()
+            busy = make_jam(traffic_jam.Timeline(filename, cache=False), sink=slow_device, send_thread=send_thread)
+            quiet = make_jam(sink=slow_device, send_thread=send_thread)
+            clock_tick = [0]
+            probe = Probe(clock_tick)
+            for obj in (busy, probe, quiet):
+                clock.register(obj)
+
+            worst = total = 0
+            for _ in range(ticks):
+                clock_tick[0] = start = time.perf_counter_ns()
+                clock.tick()
+                clock.tick_no += 1
+                elapsed = time.perf_counter_ns() - start
+                total += elapsed
+                worst = max(worst, elapsed)
+            for jam in (busy, quiet):
+                jam.shutdown()
+            sys.setswitchinterval(switch_interval)
+
+            mode = "send threads" if send_thread else "inline sends"
+            delays = sorted(probe.delays)
+            report(f"{mode} mean tick", total / ticks / 1e6, "ms")
+            report(f"{mode} worst tick", worst / 1e6, "ms")
+            report(f"{mode} 2nd device start p50", delays[len(delays) // 2] / 1e6, "ms")
+            report(f"{mode} 2nd device start max", delays[-1] / 1e6, "ms")
+    finally:
+        os.remove(filename)
+
+
+def bench_animation(ticks=400, render_time=0.002):
+    """Spelled out vs. procedural snake animation, and the lookahead buffer with an expensive pattern."""
+    import pickle
+
+    print("Animations: snake.yaml vs. a procedural fill")
+    setup_globals()
+    fd, filename = tempfile.mkstemp(suffix=".yaml", prefix="timeline_")
+    with os.fdopen(fd, "w") as f:
+        f.write("0:\n  animation: {pattern: fill, order: columns, step: 5, "
+                "colors: magenta blue cyan plum violet turquoise purple fuchsia}\n")
+    try:
+        for name, path in (("snake.yaml", "timelines/snake.yaml"), ("procedural", filename)):
+            start = time.perf_counter()
+            timeline = traffic_jam.Timeline(path, cache=False)
+            load_time = time.perf_counter() - start
+            compiled = pickle.dumps({field: getattr(timeline, field) for field in timeline.CACHED_FIELDS})
+            report(f"{name} file size", os.path.getsize(path) / 1024, "KiB")
+            report(f"{name} compiled size", len(compiled) / 1024, "KiB")
+            report(f"{name} load time", load_time * 1000, "ms")
+    finally:
+        os.remove(filename)
+
+    class Expensive(traffic_jam.ChaseAnimation):
+        """A chase that takes `render_time` to render each step, like a heavy procedural pattern would."""
+
+        def render(self, step):
+            end = time.perf_counter() + render_time
+            while time.perf_counter() < end:
+                pass
+            return super().render(step)
+
+    print(f"Animations: pattern taking {render_time * 1e3:.1f} ms per step, new step every 4 ticks")
+    for lookahead in (0, 8):
+        clock = setup_globals(ppq=96)
+        clock.unlock()
+        timeline = traffic_jam.Timeline("timelines/bar.yaml", cache=False)
+        timeline.animation_ticks = [0]
+        timeline.animations = [Expensive(step=4, length=8, colors="white cyan")]
+        jam = make_jam(timeline, animation_lookahead=lookahead)
+        clock.register(jam)
+
+        times = []
+        for _ in range(ticks):
+            # Pace the ticks like the real clock, the lookahead thread renders in between
+            time.sleep(clock.tick_length)
+            start = time.perf_counter_ns()
+            clock.tick()
+            times.append(time.perf_counter_ns() - start)
+            clock.tick_no += 1
+        misses = jam.animator.misses
+        jam.shutdown()
+
+        times.sort()
+        report(f"lookahead {lookahead} tick p50", times[len(times) // 2] / 1e3, "us")
+        report(f"lookahead {lookahead} tick p99", times[int(len(times) * 0.99)] / 1e3, "us")
+        report(f"lookahead {lookahead} not rendered ahead", misses, "ticks")
+
+
+def bench_strips(ticks=400, burst=12, swipe=10, seed=0):
+    """Eight strips swiped at once, relay load per tick and whether every value arrives in order.
+
+    The last scenario plays a dense chord timeline underneath, whose transitions cannot be
+    held back like input and have to fit into a small relay queue as well.
+    """
+    import mido
+    import random
+
+    print(f"Touch strips: 8 strips swiped together, {burst} values each per tick for {swipe} of every "
+          f"{4 * swipe} ticks")
+    rng = random.Random(seed)
+    # Values each strip sends on each tick, nothing between swipes
+    values = {48 + i: [] for i in range(8)}
+    for control, sent in values.items():
+        value = rng.randrange(128)
+        for tick in range(ticks):
+            chunk = []
+            if (tick // swipe) % 4 == 0:
+                for _ in range(burst):
+                    value = min(max(value + rng.randint(-6, 6), 0), 127)
+                    chunk.append(value)
+            sent.append(chunk)
+
+    scenarios = [
+        # name, jam options, chord timeline
+        ("unpaced", {}, False),
+        ("relay budget 32", {"relay_budget": 32, "relay_capacity": 256}, False),
+        ("rate 4, deadband 3", {"strip_input": {"rate": 4, "deadband": 3}}, False),
+        ("interpolate 4, rate 16", {"strip_input": {"rate": 16, "interpolate": 4}}, False),
+        ("chords, budget 64 of 128", {"relay_budget": 64, "relay_capacity": 128}, True),
+    ]
+    for name, kwargs, chords in scenarios:
+        clock = setup_globals()
+        clock.unlock()
+        sink = Loopback()
+        timeline = None
+        if chords:
+            # All 63 pads change with 4 notes each every 8 ticks, hundreds of relay frames at once
+            filename = write_timeline(ticks // 8, 63, 8, chord_size=4, seed=seed)
+            try:
+                timeline = traffic_jam.Timeline(filename, cache=False)
+            finally:
+                os.remove(filename)
+        jam = make_jam(timeline, sink=sink, **kwargs)
+        clock.register(jam)
+        # The initial repaint relays every strip once, leave it out of the counts
+        clock.tick()
+        clock.tick_no += 1
+        while jam.relay_queue and jam.relay_queue.queue:
+            jam.relay_queue.drain()
+        sink.received.clear()
+
+        per_tick = []
+        for tick in range(ticks):
+            for control, sent in values.items():
+                for value in sent[tick]:
+                    jam.port_in.send(mido.Message("control_change", control=control, value=value))
+            before = len(sink.received)
+            clock.tick()
+            clock.tick_no += 1
+            per_tick.append(len(sink.received) - before)
+        extra = 0
+        while jam.inbox or any(strip.pending for strip in jam.touch_strips.values()) \
+                or (jam.relay_queue and jam.relay_queue.queue):
+            before = len(sink.received)
+            clock.tick()
+            clock.tick_no += 1
+            per_tick.append(len(sink.received) - before)
+            extra += 1
+        stats = jam.stats()
+
+        relayed = {control: [] for control in values}
+        for _, data in sink.received:
+            # Strip values only, leave out the notes of the timeline
+            if data[0] == traffic_jam.CONTROL_CHANGE and data[1] in relayed:
+                relayed[data[1]].append(data[2])
+        values_sent = {control: [value for chunk in sent for value in chunk] for control, sent in values.items()}
+
+        def in_order(sent, got):
+            it = iter(got)
+            return all(value in it for value in sent)
+
+        # Deadbanded values are a subsequence of the input, interpolated ones a supersequence
+        complete = all(relayed[control] == sent for control, sent in values_sent.items())
+        ordered = all(in_order(relayed[control], sent) if "deadband" in name else in_order(sent, relayed[control])
+                      for control, sent in values_sent.items())
+        settled = all(relayed[control][-1] == sent[-1] for control, sent in values_sent.items())
+        report(f"{name} relayed", sum(map(len, relayed.values())), "frames")
+        report(f"{name} peak relay load", max(per_tick), "frames/tick")
+        report(f"{name} extra ticks to drain", extra, "ticks")
+        if stats["relay_backlog"] is not None:
+            report(f"{name} relay backlog", stats["relay_backlog"], "frames")
+            report(f"{name} input stalls", stats["relay_stalls"], "ticks")
+            report(f"{name} sent over budget", stats["relay_overflows"], "frames")
+        print(f"    every value: {complete}, in order: {ordered}, settled: {settled}, "
+              f"dropped inputs: {stats['dropped_inputs']}")
+        jam.shutdown()
+
+
+def bench_replay(messages=400, seconds=2.0, bpm=120, ppq=96):
+    """Records a live session against snake.yaml, then replays it as fast as possible and in real time."""
+    import mido
+
+    print(f"Input replay: {messages} presses and strip moves over {seconds:.0f}s at {bpm} BPM / {ppq} PPQ")
+    rng = random.Random(0)
+    workdir = tempfile.mkdtemp(prefix="replay_")
+    recording_file = os.path.join(workdir, "session.rec")
+    outputs = {name: os.path.join(workdir, f"{name}.txt") for name in ("live", "fast", "fast again", "realtime")}
+    try:
+        clock = setup_globals(bpm, ppq, instrument=True)
+        clock.unlock()
+        timeline = traffic_jam.Timeline("timelines/snake.yaml", cache=False)
+        with open(outputs["live"], "w") as f:
+            jam = make_jam(timeline, sink=traffic_jam.RenderWriter(f, clock), instrument=True)
+            recorder = traffic_jam.InputRecorder(recording_file, clock, header={
+                "bpm": bpm, "ppq": ppq, "locked": False, "timelines": ["timelines/snake.yaml"]})
+            recorder.attach([jam])
+            clock.register(jam)
+            clock.register(recorder)
+            sys.setswitchinterval(0.0005)
+            clock_thread = traffic_jam.ClockThread(clock)
+            clock_thread.start()
+            for i in range(messages):
+                if i % 2:
+                    message = mido.Message("control_change", control=48 + rng.randrange(8), value=rng.randrange(128))
+                else:
+                    message = mido.Message("note_on", note=rng.randrange(63), velocity=127 * rng.randrange(2))
+                jam.port_in.send(message)
+                time.sleep(rng.uniform(0, 2 * seconds / messages))
+            time.sleep(0.1)
+            clock_thread.stop()
+            sys.setswitchinterval(0.005)
+            recorder.close()
+            live_latency = jam.input_latency.summary()
+            live_jitter = clock.jitter.summary()
+
+        recording = traffic_jam.InputReplay(recording_file)
+        report("recording size", os.path.getsize(recording_file) / len(recording.records), "bytes/message")
+        last_tick = recording.last_tick
+        for name in ("fast", "fast again", "realtime"):
+            clock = setup_globals(bpm, ppq, instrument=name == "realtime")
+            clock.unlock()
+            timeline = traffic_jam.Timeline("timelines/snake.yaml", cache=False)
+            start = time.perf_counter()
+            traffic_jam.replay(traffic_jam.InputReplay(recording_file), [timeline], outputs[name],
+                               realtime=name == "realtime", instrument=name == "realtime")
+            report(f"{name} replay time", time.perf_counter() - start, "s")
+            if name == "realtime":
+                jam = clock.registered_objects[0]
+                report("input latency p99, live", live_latency["p99"], "ms")
+                report("input latency p99, realtime replay", jam.input_latency.summary()["p99"], "ms")
+                report("tick lateness p99, live", live_jitter["p99"], "ms")
+                report("tick lateness p99, realtime replay", clock.jitter.summary()["p99"], "ms")
+
+        def played(name):
+            # Everything sent up to the tick that took in the last message
+            with open(outputs[name]) as f:
+                return [line for line in f if int(line.split("\t", 1)[0]) <= last_tick]
+
+        print(f"    fast replays identical: {played('fast') == played('fast again')}, "
+              f"fast replay matches live: {played('fast') == played('live')}")
+    finally:
+        shutil.rmtree(workdir)
+
+
+def stream_run(class_name, filename, play, rewind_every, rewind, pause):
+    """Loads (and plays) a timeline for `bench_stream`, in a fresh process so its peak memory is its own."""
+    import json
+    import hashlib
+
+    clock = setup_globals()
+    timeline_class = getattr(traffic_jam, class_name)
+    if timeline_class is traffic_jam.StreamingTimeline:
+        # As main() does, so the prefetch thread does not hold up ticks
+        sys.setswitchinterval(0.0005)
+    start = time.perf_counter()
+    timeline = timeline_class(filename)
+    result = {"load": time.perf_counter() - start,
+              "load_rss": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss}
+    if play:
+        # Play the whole show, rewinding `rewind` ticks every `rewind_every` ticks played
+        clock.unlock()
+        digest = hashlib.sha256()
+        jam = make_jam(timeline, sink=lambda port_name, data: digest.update(b"%d %s " % (clock.tick_no, data)))
+        clock.register(jam)
+        ticks = timeline.ticks[-1] + 1
+        times = []
+        for played in range(1, ticks + ticks // rewind_every * rewind + 1):
+            start = time.perf_counter_ns()
+            clock.tick()
+            times.append(time.perf_counter_ns() - start)
+            clock.tick_no += 1
+            if played % rewind_every == 0:
+                clock.seek(clock.tick_no - rewind)
+            # Live, the prefetch thread gets to run while the clock thread sleeps until the next tick
+            time.sleep(pause)
+        times.sort()
+        result.update(p50=times[len(times) // 2], p999=times[int(len(times) * 0.999)], worst=times[-1],
+                      play_rss=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, output=digest.hexdigest(),
+                      misses=jam.stats()["timeline_misses"], loads=getattr(timeline, "loads", None))
+        jam.shutdown()
+    print(json.dumps(result))
+
+
+def bench_stream(slices=3000, pads=8, slice_length=6, rewind_every=6000, rewind=4000, pause=0.0002):
+    """Loading and playing a long show fully in memory vs. streamed, with rewinds along the way."""
+    import json
+
+    print(f"Streaming timelines: {slices} slices, {pads} pads/slice, a new slice every {slice_length} ticks, "
+          f"rewinding {rewind} ticks every {rewind_every}, {pause * 1e3:.1f} ms between ticks")
+    here = os.path.dirname(os.path.abspath(__file__))
+    filename = write_timeline(slices, pads, slice_length)
+    report("source size", os.path.getsize(filename) / 2 ** 20, "MiB")
+    outputs = {}
+    try:
+        for name, class_name in (("in memory", "Timeline"), ("streamed", "StreamingTimeline")):
+            # The first run compiles the cache, the second one loads it and plays
+            for play in (False, True):
+                code = (f"import benchmark; benchmark.stream_run({class_name!r}, {filename!r}, {play}, "
+                        f"{rewind_every}, {rewind}, {pause})")
+                output = subprocess.run([sys.executable, "-c", code], cwd=here, capture_output=True, text=True,
+                                        check=True).stdout
+                result = json.loads(output.splitlines()[-1])
+                cache = "warm" if play else "cold"
+                report(f"{name} load ({cache} cache)", result["load"] * 1000, "ms")
+                report(f"{name} peak RSS after loading ({cache} cache)", result["load_rss"] / 1024, "MiB")
+            report(f"{name} peak RSS after playing", result["play_rss"] / 1024, "MiB")
+            report(f"{name} tick p50", result["p50"] / 1e3, "us")
+            report(f"{name} tick p99.9", result["p999"] / 1e3, "us")
+            report(f"{name} worst tick", result["worst"] / 1e3, "us")
+            if result["loads"] is not None:
+                report(f"{name} chunks loaded", result["loads"], "chunks")
+                report(f"{name} chunks not prefetched", result["misses"], "chunks")
+            outputs[name] = result["output"]
+        print(f"    same output: {outputs['in memory'] == outputs['streamed']}")
+    finally:
+        cache_dir = os.path.join(os.path.dirname(filename), traffic_jam.Timeline.CACHE_DIR)
+        for cache_file in os.listdir(cache_dir):
+            if cache_file.startswith(os.path.basename(filename)):
+                os.remove(os.path.join(cache_dir, cache_file))
+        os.remove(filename)
+
+
+def bench_startup(runs=10):
+    """Launch time of a fresh interpreter, up to a loaded timeline, with cold and warm caches."""
+    print(f"Startup: fresh interpreter, best of {runs} runs")
+    here = os.path.dirname(os.path.abspath(__file__))
+    load = ("import traffic_jam as tj; tj.CLOCK = tj.Clock(); "
+            "tj.NOTE_DB = tj.NoteDB('notes.yaml', cache={cache}); tj.PALETTE = tj.Palette('palette.yaml', cache={cache}); "
+            "tj.Timeline('timeline.yaml', cache={cache})")
+    check = "; print(' '.join(name for name in ('yaml', 'mido', 'durations_nlp') if name in sys.modules))"
+    scenarios = [
+        ("python only", "pass"),
+        ("import traffic_jam", "import traffic_jam"),
+        ("load, no cache", load.format(cache=False)),
+        ("load, warm cache", load.format(cache=True)),
+    ]
+
+    # Work on copies, so the caches written here do not end up in the source tree
+    workdir = tempfile.mkdtemp(prefix="startup_")
+    try:
+        for filename in ("notes.yaml", "palette.yaml"):
+            shutil.copy(os.path.join(here, filename), workdir)
+        shutil.copy(os.path.join(here, "timelines", "snake.yaml"), os.path.join(workdir, "timeline.yaml"))
+        env = dict(os.environ, PYTHONPATH=here)
+
+        for name, code in scenarios:
+            best = float("inf")
+            for _ in range(runs):
+                start = time.perf_counter()
+                result = subprocess.run([sys.executable, "-c", "import sys; " + code + check],
+                                        cwd=workdir, env=env, capture_output=True, text=True, check=True)
+                best = min(best, time.perf_counter() - start)
+            report(name, best * 1000, "ms")
+            print(f"    heavy imports: {result.stdout.strip() or 'none'}")
+    finally:
+        shutil.rmtree(workdir)
+
+
+BENCHMARKS = {
+    "clock": bench_clock,
+    "clock_out": bench_clock_out,
+    "animation": bench_animation,
+    "cues": bench_cues,
+    "devices": bench_devices,
+    "latency": bench_latency,
+    "metrics": bench_metrics,
+    "offline": bench_offline,
+    "profile": bench_profile,
+    "render": bench_render,
+    "replay": bench_replay,
+    "runtime": bench_runtime,
+    "seek": bench_seek,
+    "sends": bench_sends,
+    "startup": bench_startup,
+    "stream": bench_stream,
+    "strips": bench_strips,
+    "suite": bench_suite,
+    "sync": bench_sync,
+    "tick": bench_tick,
+}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("names", nargs="*", metavar="name",
+                        help="Benchmarks to run ({}), all by default".format(", ".join(BENCHMARKS)))
+    parser.add_argument("-s", "--scale", type=float, dest="scale", default=1.0,
+                        metavar="factor", help="Scale the size of the synthetic timelines used by 'suite'")
+    args = parser.parse_args()
+
+    for name in args.names or BENCHMARKS:
+        if name not in BENCHMARKS:
+            print(f"Unknown benchmark: {name}")
+            sys.exit(1)
+        if name == "suite":
+            bench_suite(args.scale)
+        else:
+            BENCHMARKS[name]()
@@ -1,34 +1,162 @@
+import gc
+import os
 import sys
+import pickle
+import hashlib
+import struct
 import time
+import heapq
+import bisect
 import resource
 import argparse
+import operator
+import itertools
+import functools
+import threading
+from array import array
 from enum import IntEnum
 from abc import ABC, abstractmethod
-from collections import defaultdict
+from collections import defaultdict, deque
 
-import yaml
+# yaml, mido and durations_nlp take most of the startup time, so they are only
+# imported where they are needed. With warm caches a timeline can be loaded and
+# rendered without importing any of them. termcolor is only needed for warnings.
 
-from termcolor import colored
 
-import mido
+NOTE_ON = 0x90
+CONTROL_CHANGE = 0xB0
+SONG_POSITION = 0xF2
+TIMING_CLOCK = 0xF8
+START = 0xFA
+CONTINUE = 0xFB
+STOP = 0xFC
 
-from durations_nlp import Duration
+
+def colored(text, *args, **kwargs):
+    """`termcolor.colored`, imported on first use."""
+    from termcolor import colored
+
+    return colored(text, *args, **kwargs)
 
 
 def defaultdict_rec():
     return defaultdict(defaultdict_rec)
 
 
+def load_yaml(filename):
+    """Loads a YAML file, using the libyaml bindings if they are available."""
+    import yaml
+
+    with open(filename, "r") as f:
+        return yaml.load(f, Loader=getattr(yaml, "CFullLoader", yaml.FullLoader))
+
+
+def iter_yaml_mapping(filename):
+    """Yields the items of a top-level YAML mapping one at a time, without loading the whole file.
+
+    Each item is composed and constructed by itself, but with one loader for the whole
+    file, so aliases can refer to anchors set in earlier items.
+    """
+    import yaml
+    from yaml.composer import Composer
+
+    # The composer of the libyaml bindings only composes whole documents, the one of
+    # pure Python PyYAML is run on top of the (fast) libyaml parser instead
+    loader_class = getattr(yaml, "CFullLoader", yaml.FullLoader)
+    if not issubclass(loader_class, Composer):
+        loader_class = type("ItemLoader", (Composer, loader_class), {"__init__": loader_class.__init__})
+
+    with open(filename, "r") as f:
+        loader = loader_class(f)
+        try:
+            loader.get_event()
+            while not loader.check_event(yaml.StreamEndEvent):
+                loader.get_event()
+                # Same as `yaml.load`, anchors do not carry over to the next document
+                loader.anchors = {}
+                if not loader.check_event(yaml.MappingStartEvent):
+                    # An empty document
+                    if loader.construct_document(loader.compose_node(None, None)) is not None:
+                        raise ValueError(f"{filename} does not contain a mapping")
+                    loader.get_event()
+                    continue
+                loader.get_event()
+                while not loader.check_event(yaml.MappingEndEvent):
+                    key = loader.construct_document(loader.compose_node(None, None))
+                    value = loader.construct_document(loader.compose_node(None, None))
+                    yield key, value
+                loader.get_event()
+                loader.get_event()
+        finally:
+            loader.dispose()
+
+
+def note_outputs(note_output):
+    """Normalizes a `note_output` spec (a note, a sequence of notes or nothing) to a tuple."""
+    if not note_output:
+        return ()
+    if isinstance(note_output, int):
+        return (note_output,)
+    if isinstance(note_output, str):
+        raise TypeError(f"Expected a note number or a sequence of them, got {note_output!r}")
+    return tuple(note_output)
+
+
+def describe_frames(data):
+    """Yields a short description of each MIDI message in `data`.
+
+    Note and control changes are spelled out, anything else is written as hex.
+    This is a lot cheaper than going through `mido.parse_all`.
+    """
+    i = 0
+    while i < len(data):
+        status = data[i]
+        kind = status & 0xF0
+        if kind == NOTE_ON and i + 2 < len(data):
+            yield f"note_on channel={status & 0x0F} note={data[i + 1]} velocity={data[i + 2]}"
+            i += 3
+        elif kind == CONTROL_CHANGE and i + 2 < len(data):
+            yield f"control_change channel={status & 0x0F} control={data[i + 1]} value={data[i + 2]}"
+            i += 3
+        else:
+            yield " ".join(f"{byte:02x}" for byte in data[i:])
+            return
+
+
+def raw_sender(port):
+    """Returns a function that sends raw MIDI bytes to `port`.
+
+    Uses the rtmidi handle directly where possible, skipping `mido.Message`
+    construction and validation on the hot path.
+    """
+    rtmidi_port = getattr(port, "_rt", None)
+    if rtmidi_port is not None:
+        return rtmidi_port.send_message
+    send_bytes = getattr(port, "send_bytes", None)
+    if send_bytes is not None:
+        return send_bytes
+
+    import mido
+
+    def send(data):
+        for message in mido.parse_all(data):
+            port.send(message)
+
+    return send
+
+
 ### State Keeping ###
 
 class LedState:
 
+    __slots__ = ("color", "state")
+
     def __init__(self, color, state):
         self.color = color
         self.state = state
 
-    def color_value(self):
-        return PALETTE[self.color][self.state]
+    def color_value(self, palette=None):
+        return (palette or PALETTE)[self.color][self.state]
 
     def __repr__(self):
         return f"LedState(color={self.color}, state={self.state})"
@@ -43,6 +171,8 @@ class ButtonState(IntEnum):
 
 class Tickable(ABC):
 
+    __slots__ = ()
+
     @abstractmethod
     def tick(self, tick_no):
         pass
@@ -55,18 +185,638 @@ class NoteAction(ABC):
         pass
 
     def __call__(self, state):
-        return self.execute(state) or state
+        profiler = CLOCK.profiler
+        if profiler is None:
+            return self.execute(state) or state
+        start = time.perf_counter_ns()
+        try:
+            return self.execute(state) or state
+        finally:
+            profiler.record_action(self, start, time.perf_counter_ns())
+
+    # Actions compare by value so identical note specs can be shared between slices
+    def __eq__(self, other):
+        return type(self) is type(other) and vars(self) == vars(other)
+
+    def __hash__(self):
+        return hash((type(self), tuple(sorted(vars(self).items()))))
+
+
+class Cached(ABC):
+    """Keeps the compiled form of a source file in a cache next to it.
+
+    The cache is keyed by a hash of everything listed by `cache_sources`, so it
+    is rebuilt whenever any of those files change. Compiled fields reference
+    classes of this module by its import name, which is `__main__` when run as a
+    script and `traffic_jam` when imported, so each name keeps a cache of its own
+    and the key is checked before anything that could import the other is loaded.
+    """
+
+    # Bump whenever the compiled structures change shape
+    CACHE_VERSION = 1
+    CACHE_DIR = ".jamcache"
+    CACHED_FIELDS = ()
+
+    @property
+    def cache_path(self):
+        return os.path.join(os.path.dirname(self.filename), self.CACHE_DIR,
+                            f"{os.path.basename(self.filename)}.{type(self).__name__.lower()}."
+                            f"{__name__.strip('_')}.pickle")
+
+    @abstractmethod
+    def cache_sources(self):
+        pass
+
+    def cache_salt(self):
+        """Anything besides the source files the compiled fields depend on."""
+        return ""
+
+    def cache_key(self):
+        """Hashes everything the compiled fields depend on."""
+        key = hashlib.sha256(f"{self.CACHE_VERSION}:{__name__}:{self.cache_salt()}".encode())
+        for filename in self.cache_sources():
+            with open(filename, "rb") as f:
+                for block in iter(lambda: f.read(1 << 20), b""):
+                    key.update(block)
+        return key.hexdigest()
+
+    def load_cache(self):
+        try:
+            with open(self.cache_path, "rb") as f:
+                if pickle.load(f) != self.cache_key():
+                    return False
+                fields = pickle.load(f)
+        except Exception:
+            # Missing, truncated or written by an incompatible version, just rebuild it
+            return False
+        self.__dict__.update(fields)
+        return True
+
+    def save_cache(self):
+        fields = {name: getattr(self, name) for name in self.CACHED_FIELDS}
+        tmp_path = self.cache_path + ".tmp"
+        try:
+            os.makedirs(os.path.dirname(self.cache_path), exist_ok=True)
+            with open(tmp_path, "wb") as f:
+                pickle.dump(self.cache_key(), f, protocol=pickle.HIGHEST_PROTOCOL)
+                pickle.dump(fields, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, self.cache_path)
+        except OSError as e:
+            print(colored("Warning:", "yellow"), f"Could not write cache {self.cache_path}: {e}")
 
 
 ### Utility Classes ###
 
-class Palette:
+class Cue:
+    """Handle for a scheduled cue, returned by `Clock.register_cue`."""
+
+    __slots__ = ("when", "func", "args", "every", "cancelled", "pending", "scheduler")
+
+    def __init__(self, scheduler, when, func, args, every=None):
+        self.scheduler = scheduler
+        self.when = when
+        self.func = func
+        self.args = args
+        self.every = every
+        self.cancelled = False
+        self.pending = False
+
+    def cancel(self):
+        if self.cancelled:
+            return
+        self.cancelled = True
+        if self.pending:
+            self.scheduler.cancelled += 1
+
+    def __repr__(self):
+        return f"Cue(when={self.when}, func={self.func.__name__}, every={self.every}, cancelled={self.cancelled})"
+
+
+class CueScheduler:
+    """Priority queue of cues ordered by due tick.
+
+    Cues due on the same tick fire in the order they were scheduled. Cancelled
+    cues stay in the heap until they are popped (or until they make up more than
+    half of it, at which point the heap is compacted).
+    """
+
+    def __init__(self):
+        self.heap = []
+        self.counter = itertools.count()
+        self.cancelled = 0
+
+    def schedule(self, when, func, args=(), every=None):
+        if every is not None and every < 1:
+            raise ValueError(f"Recurring cues need an interval of at least one tick, got {every}")
+        cue = Cue(self, when, func, tuple(args), every)
+        self.push(cue)
+        return cue
+
+    def push(self, cue):
+        cue.pending = True
+        heapq.heappush(self.heap, (cue.when, next(self.counter), cue))
+
+    def pop_due(self, tick_no):
+        """Removes and returns all live cues due at or before `tick_no`."""
+        heap = self.heap
+        due = []
+        while heap and heap[0][0] <= tick_no:
+            cue = heapq.heappop(heap)[2]
+            cue.pending = False
+            if cue.cancelled:
+                self.cancelled -= 1
+            else:
+                due.append(cue)
+        return due
+
+    def run_due(self, tick_no):
+        if not self.heap or self.heap[0][0] > tick_no:
+            return
+
+        for cue in self.pop_due(tick_no):
+            # A cue may have been cancelled by another one due on the same tick
+            if cue.cancelled:
+                continue
+            cue.func(*cue.args)
+            if cue.every and not cue.cancelled:
+                cue.when += cue.every
+                self.push(cue)
+
+        if self.cancelled > len(self.heap) // 2:
+            self.compact()
+
+    def compact(self):
+        for _, _, cue in self.heap:
+            if cue.cancelled:
+                cue.pending = False
+        self.heap = [entry for entry in self.heap if not entry[2].cancelled]
+        heapq.heapify(self.heap)
+        self.cancelled = 0
+
+    def __len__(self):
+        return len(self.heap) - self.cancelled
+
+
+class LatencyStats:
+    """Fixed-size ring buffer of latency samples in nanoseconds."""
+
+    def __init__(self, size=4096):
+        self.samples = array("q", bytes(8 * size))
+        self.size = size
+        self.count = 0
+        self.max = 0
+
+    def record(self, value):
+        self.samples[self.count % self.size] = value
+        self.count += 1
+        if value > self.max:
+            self.max = value
+
+    def percentile(self, fraction):
+        """Returns the given percentile (0.0-1.0) of the most recent samples."""
+        samples = sorted(self.samples[:min(self.count, self.size)])
+        if not samples:
+            return 0
+        return samples[min(int(fraction * len(samples)), len(samples) - 1)]
+
+    def summary(self):
+        """Returns p50/p99/max in milliseconds along with the number of samples."""
+        return {
+            "count": self.count,
+            "p50": self.percentile(0.5) / 1e6,
+            "p99": self.percentile(0.99) / 1e6,
+            "max": self.max / 1e6,
+        }
+
+    def __str__(self):
+        summary = self.summary()
+        return "p50 {p50:.3f} ms, p99 {p99:.3f} ms, max {max:.3f} ms ({count} samples)".format(**summary)
+
+
+class LedBuffer:
+    """Collects the device LED frames of one tick and writes them out together.
+
+    Controls use it in place of the device port. Frames are coalesced per LED
+    (the last write of a tick wins) and compared against a shadow copy of what
+    the device currently shows, so repeated writes of the same color are dropped.
+    Each frame still goes out as a send of its own: the Maschine Jam has no
+    documented SysEx for bulk LED updates in MIDI mode, and rtmidi rejects
+    anything longer than a single message that is not SysEx.
+    With `count`, the frames sent and dropped are counted in `sent` and `dropped`.
+    """
+
+    def __init__(self, port, count=False):
+        self.port = port
+        self.send = raw_sender(port)
+        self.shadow = {}
+        self.pending = {}
+        self.count = count
+        self.sent = 0
+        self.dropped = 0
+
+    def send_bytes(self, frame):
+        # The status and data byte address the LED
+        key = frame[0] << 8 | frame[1]
+        if self.shadow.get(key) == frame:
+            self.pending.pop(key, None)
+            if self.count:
+                self.dropped += 1
+        else:
+            self.pending[key] = frame
+
+    def flush(self):
+        if not self.pending:
+            return
+
+        send = self.send
+        for frame in self.pending.values():
+            send(frame)
+
+        self.shadow.update(self.pending)
+        if self.count:
+            self.sent += len(self.pending)
+        self.pending = {}
+
+    def close(self):
+        self.flush()
+        self.port.close()
+
+
+class LockedPort:
+    """Serializes raw sends to a port that is written to from more than one thread."""
+
+    def __init__(self, port):
+        self.port = port
+        self.send = raw_sender(port)
+        self.lock = threading.Lock()
+
+    def send_bytes(self, data):
+        with self.lock:
+            self.send(data)
+
+    def close(self):
+        self.port.close()
+
+
+class QueuedPort:
+    """Hands raw sends to a port over to a `SendWorker`, which writes them on its own thread."""
+
+    def __init__(self, port, worker):
+        self.port = port
+        self.worker = worker
+        self.send = raw_sender(port)
+
+    def send_bytes(self, data):
+        self.worker.put(self.send, data)
+
+    def close(self):
+        self.port.close()
+
+
+class SendWorker(threading.Thread):
+    """Writes out everything queued through its `QueuedPort`s, in order, on a thread of its own.
+
+    With one worker per device a slow write to one device (e.g. a full repaint)
+    never holds up the ticks of another. This only pays off with MIDI backends
+    that release the GIL while writing, which blocking device writes usually do.
+    """
+
+    def __init__(self, name):
+        super().__init__(name=name, daemon=True)
+        self.queue = deque()
+        self.ready = threading.Event()
+        self.running = True
+        self.written = 0
+        self.max_backlog = 0
+
+    def put(self, send, data):
+        self.queue.append((send, data))
+        self.ready.set()
+
+    def run(self):
+        queue = self.queue
+        while self.running or queue:
+            self.ready.wait()
+            self.ready.clear()
+            if len(queue) > self.max_backlog:
+                self.max_backlog = len(queue)
+            while queue:
+                send, data = queue.popleft()
+                send(data)
+                self.written += 1
+
+    def stop(self):
+        """Writes out whatever is still queued, then stops."""
+        self.running = False
+        self.ready.set()
+        self.join()
+
+
+class CountingPort:
+    """Counts the raw sends going to a port."""
+
+    def __init__(self, port):
+        self.port = port
+        self.send = raw_sender(port)
+        self.sent = 0
+
+    def send_bytes(self, data):
+        self.sent += 1
+        self.send(data)
+
+    def close(self):
+        self.port.close()
+
+
+class RelayQueue:
+    """Bounded queue in front of the relay port, written out at most `budget` frames per tick.
+
+    Nothing is ever dropped here: the jam only takes as much input off its inbox
+    each tick as there is room below `capacity`, the rest waits there in order.
+    Frames that cannot be held back, i.e. timeline transitions, actions, chords and
+    interpolated strip values, still count against `capacity`: once it is reached
+    the oldest queued frame is written out right away, ahead of the budget. So the
+    budget only holds while the queue is below `capacity`, a burst of chords can
+    write out more than `budget` frames in one tick. The inbox in front of it is
+    bounded as well, see `MaschineJam.process_message`.
+    `stalls` counts the ticks input was held back, `overflows` the frames written
+    out over the budget and `max_backlog` is the longest the queue got.
+    Immediately relayed input goes through `send_now` on the MIDI input thread, so
+    the queue is only ever written out with `lock` held.
+    """
+
+    def __init__(self, port, budget=64, capacity=1024):
+        self.port = port
+        self.send = raw_sender(port)
+        self.budget = budget
+        self.capacity = capacity
+        self.queue = deque()
+        self.lock = threading.Lock()
+        self.queued = 0
+        self.max_backlog = 0
+        self.stalls = 0
+        self.overflows = 0
+
+    def send_bytes(self, data):
+        queue = self.queue
+        if len(queue) >= self.capacity:
+            # Full, make room in order rather than growing past the bound
+            with self.lock:
+                if queue:
+                    self.send(queue.popleft())
+            self.overflows += 1
+            self.max_backlog = self.capacity
+        queue.append(data)
+        self.queued += 1
+
+    def send_now(self, data):
+        """Writes out everything queued and then `data`, regardless of the budget.
+
+        An earlier note off still in the queue must not reach the DAW after a note on sent right away.
+        """
+        with self.lock:
+            queue = self.queue
+            send = self.send
+            while queue:
+                send(queue.popleft())
+            send(data)
+
+    def room(self):
+        return max(self.capacity - len(self.queue), 0)
+
+    def drain(self):
+        queue = self.queue
+        if len(queue) > self.max_backlog:
+            self.max_backlog = len(queue)
+        send = self.send
+        with self.lock:
+            for _ in range(min(self.budget, len(queue))):
+                send(queue.popleft())
+
+    def flush(self):
+        """Writes out everything queued, regardless of the budget."""
+        with self.lock:
+            while self.queue:
+                self.send(self.queue.popleft())
+
+    def close(self):
+        self.flush()
+        self.port.close()
+
+
+class MockInput:
+    """Input port of the `MockBackend`, `send` feeds a message to its callback."""
+
+    def __init__(self, name):
+        self.name = name
+        self.callback = None
+
+    def send(self, message):
+        if self.callback:
+            self.callback(message)
+
+    def close(self):
+        self.callback = None
+
+
+class MockOutput:
+    """Output port of the `MockBackend`, passes everything sent to it on to a sink."""
+
+    def __init__(self, name, sink=None):
+        self.name = name
+        self.sink = sink
+
+    def send(self, message):
+        self.send_bytes(message.bin())
+
+    def send_bytes(self, data):
+        if self.sink:
+            self.sink(self.name, data)
+
+    def close(self):
+        pass
+
+
+class MockBackend:
+    """Drop-in replacement for the port functions of `mido`, for running without a device.
+
+    Everything written to its output ports is handed to `sink(port_name, data)`.
+    """
+
+    def __init__(self, sink=None):
+        self.sink = sink
+        self.inputs = {}
+        self.outputs = {}
+
+    def open_input(self, name, **kwargs):
+        port = self.inputs[name] = MockInput(name)
+        return port
+
+    def open_output(self, name, **kwargs):
+        port = self.outputs[name] = MockOutput(name, self.sink)
+        return port
+
+    def get_input_names(self):
+        return list(self.inputs)
+
+    def get_output_names(self):
+        return list(self.outputs)
+
+
+class RenderWriter:
+    """Mock backend sink writing each message as a line of text, stamped with the current tick."""
+
+    def __init__(self, file, clock):
+        self.file = file
+        self.clock = clock
+        self.messages = 0
+
+    def __call__(self, port_name, data):
+        tick_no = self.clock.tick_no
+        for message in describe_frames(data):
+            self.file.write(f"{tick_no}\t{port_name}\t{message}\n")
+            self.messages += 1
+
+
+class InputRecorder(Tickable):
+    """Logs every input message to a compact append-only file, to replay the session later.
+
+    The file starts with a magic line and a JSON header line, followed by one binary
+    record per message: its arrival time in ns since recording started, the device
+    tick that took it in, the clock's tick number, the device index, whether it was
+    dropped and the raw MIDI bytes. Devices record messages as they take them in,
+    registered on the clock after them the recorder writes each tick's records out in
+    one go, so a session cut short loses at most its last tick.
+    """
+
+    MAGIC = b"TJREC1\n"
+    RECORD = struct.Struct("<qIIBBH")
+
+    def __init__(self, filename, clock, header=None):
+        import json
+
+        self.filename = filename
+        self.clock = clock
+        self.file = open(filename, "wb", buffering=0)
+        self.file.write(self.MAGIC + json.dumps(header or {}).encode() + b"\n")
+        self.lock = threading.Lock()
+        self.pending = bytearray()
+        self.start = time.perf_counter_ns()
+        self.records = 0
+
+    def attach(self, jams):
+        for i, jam in enumerate(jams):
+            jam.record = functools.partial(self.record, jam, i)
+
+    def record(self, jam, device, timestamp, message, dropped=False):
+        """Called by `jam` for each message it takes in, or on its input thread for one it dropped."""
+        data = message.bin()
+        # A dropped message never made it to a tick, it is filed under the one it missed
+        ticks = jam.ticks if dropped else jam.ticks - 1
+        record = self.RECORD.pack(timestamp - self.start, ticks, self.clock.tick_no, device, dropped, len(data))
+        with self.lock:
+            self.pending += record
+            self.pending += data
+            self.records += 1
+
+    def tick(self, tick_no):
+        if self.pending:
+            with self.lock:
+                pending, self.pending = self.pending, bytearray()
+            self.file.write(pending)
+
+    def close(self):
+        self.tick(self.clock.tick_no)
+        self.file.close()
+
+
+class InputReplay(Tickable):
+    """Feeds a session recorded by an `InputRecorder` back into the input ports of mock devices.
+
+    Registered on the clock ahead of the devices, it hands each message over right
+    before the tick that took it in live, so replaying renders the same output every
+    time. Messages dropped live are left out. `feed` sends all of them at the times
+    they arrived instead, in real time.
+    """
 
     def __init__(self, filename):
-        self.data = defaultdict(dict)
+        import json
+        import mido
+
+        with open(filename, "rb") as f:
+            data = f.read()
+        magic, record = InputRecorder.MAGIC, InputRecorder.RECORD
+        if not data.startswith(magic):
+            raise ValueError(f"{filename} is not an input recording")
+        end = data.index(b"\n", len(magic))
+        self.filename = filename
+        self.header = json.loads(data[len(magic):end])
+        # (arrival time, device tick, device, dropped, message), in the order the ticks took them in
+        self.records = []
+        offset = end + 1
+        while offset + record.size <= len(data):
+            timestamp, ticks, _, device, dropped, length = record.unpack_from(data, offset)
+            offset += record.size
+            if offset + length > len(data):
+                # Cut short while writing the last record
+                break
+            message = mido.Message.from_bytes(data[offset:offset + length])
+            self.records.append((timestamp, ticks, device, bool(dropped), message))
+            offset += length
+        self.by_tick = sorted((record for record in self.records if not record[3]), key=lambda record: record[1])
+        self.by_time = sorted(self.records, key=lambda record: record[0])
+        self.dropped = len(self.records) - len(self.by_tick)
+        # Devices nothing was received from still had their timelines playing
+        self.devices = max(max((record[2] for record in self.records), default=0) + 1,
+                           len(self.header.get("devices", ())))
+        self.ports = []
+        self.position = 0
+        self.ticks = 0
+
+    @property
+    def last_tick(self):
+        return self.by_tick[-1][1] if self.by_tick else 0
+
+    def attach(self, ports):
+        """Sets the input port to feed for each recorded device."""
+        self.ports = ports
+
+    def tick(self, tick_no):
+        records = self.by_tick
+        while self.position < len(records) and records[self.position][1] <= self.ticks:
+            _, _, device, _, message = records[self.position]
+            self.ports[device].send(message)
+            self.position += 1
+        self.ticks += 1
+
+    def feed(self):
+        """Sends every message as long after the call as it arrived after recording started."""
+        start = time.perf_counter_ns()
+        for timestamp, _, device, _, message in self.by_time:
+            remaining = start + timestamp - time.perf_counter_ns()
+            if remaining > 0:
+                time.sleep(remaining / 1e9)
+            self.ports[device].send(message)
+
+
+class Palette(Cached):
+
+    CACHED_FIELDS = ("data",)
+
+    def __init__(self, filename, cache=True):
+        self.filename = filename
+        if cache and self.load_cache():
+            return
+        self.parse(filename)
+        if cache:
+            self.save_cache()
 
-        with open(filename, "r") as f:
-            palette_data = yaml.full_load(f)
+    def cache_sources(self):
+        return (self.filename,)
+
+    def parse(self, filename):
+        self.data = defaultdict(dict)
+        palette_data = load_yaml(filename)
 
         for color_name, start in palette_data["colors"].items():
             for state_name, index in palette_data["states"].items():
@@ -88,11 +838,23 @@ class Palette:
         del self.data[key]
 
 
-class NoteDB:
+class NoteDB(Cached):
 
-    def __init__(self, filename):
-        with open(filename, "r") as f:
-            notes_data = yaml.full_load(f)
+    CACHED_FIELDS = ("data",)
+
+    def __init__(self, filename, cache=True):
+        self.filename = filename
+        if cache and self.load_cache():
+            return
+        self.parse(filename)
+        if cache:
+            self.save_cache()
+
+    def cache_sources(self):
+        return (self.filename,)
+
+    def parse(self, filename):
+        notes_data = load_yaml(filename)
 
         self.data = {}
         for i, step in enumerate(range(0, 132, 12)):
@@ -118,70 +880,250 @@ class NoteDB:
         del self.data[key]
 
 
-class Timeline:
+class Timeline(Cached):
 
-    def __init__(self, filename):
-        with open(filename, "r") as f:
-            timeline_data = yaml.full_load(f)
+    CACHE_VERSION = 4
+    CACHED_FIELDS = ("data", "specs", "ticks", "states", "transitions", "animation_ticks", "animations")
+
+    def __init__(self, filename, cache=True, palette=None, note_db=None):
+        self.filename = filename
+        # Normally the global tables, a reload compiles against new ones before they are swapped in
+        self.palette = palette or PALETTE
+        self.note_db = note_db or NOTE_DB
+        # Devices playing it, see `acquire`
+        self.users = 0
+        if cache and self.load_cache():
+            return
+        self.parse(filename)
+        if cache:
+            self.save_cache()
+
+    def cache_sources(self):
+        return (self.filename, self.note_db.filename, self.palette.filename)
+
+    def cache_salt(self):
+        return f"{CLOCK.bpm}:{CLOCK.ppq}"
+
+    def parse(self, filename):
+        timeline_data = load_yaml(filename)
 
         self.data = dict()
+        # Equal note specs are interned, so comparing specs between slices is an identity check
+        self.specs = {}
+        animations = {}
         for index, time_spec in timeline_data.items():
+            tick_index = self.parse_tick(index)
+            time_slice = self.parse_slice(tick_index, time_spec, animations)
+            # A slice without notes, e.g. one that only changes the animation, leaves the notes alone
+            if time_slice:
+                self.data[tick_index] = time_slice
+
+        self.animation_ticks = sorted(animations)
+        self.animations = [animations[tick_index] for tick_index in self.animation_ticks]
+        self.build_index()
+
+    @staticmethod
+    def parse_tick(index):
+        try:
+            # if bare int treat as tick value
+            return int(index)
+        except:
+            # otherwise treat as natural language duration
+            from durations_nlp import Duration
+            return round(CLOCK.seconds_to_ticks(Duration(index).to_seconds()))
+
+    def parse_slice(self, tick_index, time_spec, animations):
+        """Compiles the note specs of one slice, adding an animation set by it to `animations`."""
+        time_slice = defaultdict_rec()
+
+        for note, note_spec in time_spec.items():
+            if note == "animation":
+                # Runs from this slice until the next animation (or none) is set
+                animations[tick_index] = self.parse_animation(note_spec)
+                continue
+
             try:
-                # if bare int treat as tick value
-                tick_index = int(index)
+                note = int(note)
             except:
-                # otherwise treat as natural language duration
-                tick_index = CLOCK.seconds_to_ticks(Duration(index).to_seconds())
-            self.data[tick_index] = defaultdict_rec()
-
-            for note, note_spec in time_spec.items():
-                try:
-                    note = int(note)
-                except:
-                    pass
+                pass
 
-                self.data[tick_index][note]["channel"] = note_spec.get("channel", 0)
+            time_slice[note]["channel"] = note_spec.get("channel", 0)
 
-                self.data[tick_index][note]["sticky"] = note_spec.get("sticky", False)
+            time_slice[note]["sticky"] = note_spec.get("sticky", False)
 
-                action_spec = note_spec.get("action", None)
-                if not action_spec:
-                    self.data[tick_index][note]["action"] = None
+            action_spec = note_spec.get("action", None)
+            if not action_spec:
+                time_slice[note]["action"] = None
+            else:
+                tokens = action_spec.split()
+                if tokens[0] == "print":
+                    time_slice[note]["action"] = PrintAction(" ".join(tokens[1:]))
                 else:
-                    tokens = action_spec.split()
-                    if tokens[0] == "print":
-                        self.data[tick_index][note]["action"] = PrintAction(" ".join(tokens[1:]))
-
-                # Note Action
-                note_output_spec = note_spec.get("note", None)
-                if not note_output_spec:
-                    self.data[tick_index][note]["note_output"] = note
+                    raise ValueError(f"Slice {tick_index}, note {note!r}: unknown action {tokens[0]!r}")
+
+            # Note Action
+            note_output_spec = note_spec.get("note", None)
+            if not note_output_spec:
+                # Controls send on their own note or CC unless told otherwise
+                if isinstance(note, int):
+                    time_slice[note]["note_output"] = note
+                elif note.startswith("cc"):
+                    time_slice[note]["note_output"] = int(note.lstrip("cc"))
                 else:
-                    if isinstance(note_output_spec, str):
-                        note_output = []
-                        for _note in note_output_spec.split():
-                            note_output.append(NOTE_DB.get(_note))
-                        note_output = tuple(note_output)
-                    else:
-                        note_output = note_output_spec
-                    self.data[tick_index][note]["note_output"] = note_output
-
-                # LED State
-                led_spec = note_spec.get("led", None)
-
-                if not led_spec:
-                    led_state_active = LedState(color="orange", state="bright")
-                    led_state_inactive = LedState(color="orange", state="dim")
+                    time_slice[note]["note_output"] = None
+            else:
+                if isinstance(note_output_spec, str):
+                    note_output = []
+                    for _note in note_output_spec.split():
+                        note_output.append(self.note_db.get(_note))
+                    note_output = tuple(note_output)
                 else:
-                    led_spec_active = led_spec.get("active", {})
-                    led_spec_inactive = led_spec.get("inactive", {})
-                    led_state_active = LedState(color=led_spec_active.get("color", "orange"),
-                                                state=led_spec_active.get("state", "bright"))
-                    led_state_inactive = LedState(color=led_spec_inactive.get("color", "orange"),
-                                                  state=led_spec_inactive.get("state", "dim"))
+                    note_output = note_output_spec
+                time_slice[note]["note_output"] = note_output
+
+            # LED State
+            led_spec = note_spec.get("led", None)
 
-                self.data[tick_index][note]["led_state"]["active"] = led_state_active
-                self.data[tick_index][note]["led_state"]["inactive"] = led_state_inactive
+            if not led_spec:
+                led_state_active = LedState(color="orange", state="bright")
+                led_state_inactive = LedState(color="orange", state="dim")
+            else:
+                led_spec_active = led_spec.get("active", {})
+                led_spec_inactive = led_spec.get("inactive", {})
+                led_state_active = LedState(color=led_spec_active.get("color", "orange"),
+                                            state=led_spec_active.get("state", "bright"))
+                led_state_inactive = LedState(color=led_spec_inactive.get("color", "orange"),
+                                              state=led_spec_inactive.get("state", "dim"))
+
+            time_slice[note]["led_state"]["active"] = led_state_active
+            time_slice[note]["led_state"]["inactive"] = led_state_inactive
+
+            # Raw frames are not validated when sent, so out of range values have to fail here
+            self.check_spec(tick_index, note, time_slice[note])
+
+            # Precompiled MIDI frames for the control this note maps to
+            if isinstance(note, int):
+                frames = Button.compile_frames(note, led_state_active, led_state_inactive,
+                                               time_slice[note]["note_output"],
+                                               time_slice[note]["channel"], self.palette)
+            elif note.startswith("cc"):
+                frames = CCButton.compile_frames(int(note.lstrip("cc")), led_state_active, led_state_inactive,
+                                                 time_slice[note]["note_output"],
+                                                 palette=self.palette)
+            else:
+                frames = None
+            time_slice[note]["frames"] = frames
+
+            spec = time_slice[note]
+            time_slice[note] = self.specs.setdefault((note,) + self.spec_key(spec), spec)
+
+        return time_slice
+
+    @staticmethod
+    def check_spec(tick_index, note, spec):
+        """Checks that everything of a note spec packed into MIDI frames fits in its byte."""
+        def check(value, what, limit=127):
+            if not isinstance(value, int) or not 0 <= value <= limit:
+                raise ValueError(f"Slice {tick_index}, note {note!r}: {what} must be in range 0..{limit}, "
+                                 f"got {value!r}")
+
+        if isinstance(note, int):
+            check(note, "note")
+        elif note.startswith("cc"):
+            check(int(note.lstrip("cc")), "control")
+        check(spec["channel"], "channel", 15)
+        try:
+            outputs = note_outputs(spec["note_output"])
+        except TypeError as e:
+            raise ValueError(f"Slice {tick_index}, note {note!r}: {e}") from None
+        for output in outputs:
+            check(output, "note_output")
+
+    def parse_animation(self, animation_spec):
+        if not animation_spec:
+            return None
+        animation_spec = dict(animation_spec)
+        pattern = animation_spec.pop("pattern", None)
+        if pattern not in ANIMATIONS:
+            raise ValueError(f"Unknown animation pattern {pattern!r}, expected one of {tuple(ANIMATIONS)}")
+        return ANIMATIONS[pattern](palette=self.palette, **animation_spec)
+
+    @staticmethod
+    def spec_key(spec):
+        """Returns what makes two note specs equivalent, across timelines too."""
+        return (spec["frames"], spec["action"], spec["sticky"])
+
+    @staticmethod
+    def relay_key(spec):
+        """Returns what of a note spec reaches the DAW, i.e. everything but its LED colors."""
+        frames = spec["frames"]
+        return (frames and tuple(relay_frames for _, relay_frames in frames), spec["action"], spec["sticky"])
+
+    @classmethod
+    def equivalent(cls, spec, other):
+        """Compares two note specs that are not necessarily interned in the same table."""
+        return spec is other or cls.spec_key(spec) == cls.spec_key(other)
+
+    @staticmethod
+    def effective_states(slices):
+        """Yields the (tick, effective state) of each of the (tick, slice) pairs `slices`, in tick order.
+
+        The effective state of a slice is what is configured while it is active when
+        playing from the start: its own notes plus sticky notes left over from earlier slices.
+        """
+        state = {}
+        previous = {}
+        for tick_index, time_slice in slices:
+            # Non-sticky notes of the previous slice are reset when it ends
+            state = {note: spec for note, spec in state.items() if spec["sticky"] or note not in previous}
+            state.update(time_slice)
+            yield tick_index, state
+            previous = time_slice
+
+    @staticmethod
+    def changes_between(old_state, new_state, same=operator.is_):
+        """Lists the (note, old spec, new spec) changes between two effective states.
+
+        Specs are compared with `same`, by identity unless they may come from different
+        intern tables.
+        """
+        changes = [(note, spec, None) for note, spec in old_state.items() if note not in new_state]
+        for note, spec in new_state.items():
+            old_spec = old_state.get(note)
+            if old_spec is None or not same(old_spec, spec):
+                changes.append((note, old_spec, spec))
+        return changes
+
+    def build_index(self):
+        """Sorts the slice boundaries and computes the effective state at each of them."""
+        self.ticks = sorted(self.data)
+        self.states = [state for _, state in
+                       self.effective_states((tick_index, self.data[tick_index]) for tick_index in self.ticks)]
+
+        # Precompiled changes for moving from each slice to the next one
+        self.transitions = []
+        for index in range(len(self.ticks)):
+            self.transitions.append(self.diff(index - 1, index))
+
+    def index_at(self, tick_no):
+        """Returns the index of the slice active at `tick_no`, or -1 before the first slice."""
+        return bisect.bisect_right(self.ticks, tick_no) - 1
+
+    def state_at(self, index):
+        return self.states[index] if index >= 0 else {}
+
+    def animation_at(self, tick_no):
+        """Returns the (start tick, animation) active at `tick_no`, or None."""
+        index = bisect.bisect_right(self.animation_ticks, tick_no) - 1
+        if index < 0:
+            return None
+        return self.animation_ticks[index], self.animations[index]
+
+    def diff(self, from_index, to_index):
+        """Lists the (note, old spec, new spec) changes between the effective states of two slices."""
+        if to_index == from_index + 1 and len(self.transitions) > to_index:
+            return self.transitions[to_index]
+        return self.changes_between(self.state_at(from_index), self.state_at(to_index))
 
     def get(self, key, default=None):
         return self.data.get(key, default)
@@ -198,6 +1140,215 @@ class Timeline:
     def __delitem__(self, key):
         del self.data[key]
 
+    def acquire(self):
+        """Registers one more device playing this timeline, see `release`."""
+        self.users += 1
+
+    def release(self):
+        """Closes the timeline once the last device playing it lets go of it."""
+        self.users -= 1
+        if self.users <= 0:
+            self.close()
+
+    def close(self):
+        pass
+
+
+class StreamingTimeline(Timeline):
+    """A timeline played from a chunked file, keeping only a window around the playhead in memory.
+
+    The source is compiled slice by slice, in tick order, into a stream file in the
+    cache directory: chunks of `CHUNK_SLICES` effective slice states, followed by an
+    index of the slice ticks, chunk offsets and animations. While playing, a prefetch
+    thread loads the `ahead` chunks after the current one and evicts all but `behind`
+    chunks before it. Seeking anywhere else, e.g. rewinding, loads the chunk there on
+    the spot.
+    """
+
+    CACHE_VERSION = 3
+    CHUNK_SLICES = 16
+    TRAILER = struct.Struct("<Q")
+
+    def __init__(self, filename, cache=True, palette=None, note_db=None, ahead=8, behind=4):
+        self.filename = filename
+        self.palette = palette or PALETTE
+        self.note_db = note_db or NOTE_DB
+        self.users = 0
+        self.ahead = ahead
+        self.behind = behind
+        # Loaded chunks by number, the chunk of the slice last looked up
+        self.chunks = {}
+        self.chunk = 0
+        self.loads = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        key = self.cache_key()
+        if not (cache and self.open_stream(key)):
+            self.compile(key)
+            if not self.open_stream(key):
+                raise OSError(f"Could not read back {self.cache_path}")
+        self.wanted = threading.Event()
+        self.running = True
+        self.prefetcher = threading.Thread(target=self.prefetch, name=f"prefetch {filename}", daemon=True)
+        self.prefetcher.start()
+        self.wanted.set()
+
+    def compile(self, key):
+        """Compiles the source into the stream file, one slice at a time."""
+        tmp_path = self.cache_path + ".tmp"
+        os.makedirs(os.path.dirname(self.cache_path), exist_ok=True)
+        try:
+            self.write_stream(tmp_path, key)
+        except BaseException:
+            # Half written, e.g. the source has a slice out of order
+            os.remove(tmp_path)
+            raise
+        os.replace(tmp_path, self.cache_path)
+
+    def write_stream(self, path, key):
+        ticks = array("q")
+        offsets = []
+        animations = {}
+        chunk = []
+
+        def parse_slices():
+            # Parsed lazily, so each slice is interned in the table of the chunk it ends up in
+            last = None
+            for index, time_spec in iter_yaml_mapping(self.filename):
+                tick_index = self.parse_tick(index)
+                if last is not None and tick_index <= last:
+                    raise ValueError(f"Slice {index!r} of {self.filename} is out of order, "
+                                     f"streaming timelines need their slices in tick order")
+                last = tick_index
+                time_slice = self.parse_slice(tick_index, time_spec, animations)
+                # Same as `Timeline.parse`, slices without notes leave the notes alone
+                if time_slice:
+                    yield tick_index, time_slice
+
+        with open(path, "wb") as f:
+            def flush():
+                offsets.append(f.tell())
+                pickle.dump(chunk, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+            # Specs are only interned within a chunk, so the table never holds more than one chunk's worth
+            self.specs = {}
+            for tick_index, state in self.effective_states(parse_slices()):
+                ticks.append(tick_index)
+                chunk.append(state)
+                if len(chunk) == self.CHUNK_SLICES:
+                    flush()
+                    chunk = []
+                    self.specs = {}
+            if chunk:
+                flush()
+            self.specs = {}
+
+            index_offset = f.tell()
+            animation_ticks = sorted(animations)
+            pickle.dump(key, f, protocol=pickle.HIGHEST_PROTOCOL)
+            pickle.dump({"ticks": ticks, "offsets": offsets, "animation_ticks": animation_ticks,
+                         "animations": [animations[tick_index] for tick_index in animation_ticks]},
+                        f, protocol=pickle.HIGHEST_PROTOCOL)
+            f.write(self.TRAILER.pack(index_offset))
+
+    def open_stream(self, key):
+        try:
+            f = open(self.cache_path, "rb")
+        except OSError:
+            return False
+        try:
+            f.seek(-self.TRAILER.size, os.SEEK_END)
+            (index_offset,) = self.TRAILER.unpack(f.read(self.TRAILER.size))
+            f.seek(index_offset)
+            if pickle.load(f) != key:
+                f.close()
+                return False
+            index = pickle.load(f)
+        except Exception:
+            # Truncated or written by an incompatible version, just rebuild it
+            f.close()
+            return False
+        self.file = f
+        self.ticks = index["ticks"]
+        self.offsets = index["offsets"]
+        self.animation_ticks = index["animation_ticks"]
+        self.animations = index["animations"]
+        return True
+
+    def load_chunk(self, chunk_no):
+        with self.lock:
+            self.file.seek(self.offsets[chunk_no])
+            states = pickle.load(self.file)
+            self.loads += 1
+        self.chunks[chunk_no] = states
+        return states
+
+    def prefetch(self):
+        while self.running:
+            self.wanted.wait()
+            self.wanted.clear()
+            if not self.running:
+                break
+            current = self.chunk
+            keep = range(max(current - self.behind, 0), min(current + self.ahead + 1, len(self.offsets)))
+            # The current chunk first, in case it was not looked up yet
+            for chunk_no in keep[current - keep.start:]:
+                if chunk_no not in self.chunks:
+                    self.load_chunk(chunk_no)
+            for chunk_no in list(self.chunks):
+                if chunk_no not in keep:
+                    self.chunks.pop(chunk_no, None)
+
+    def state_at(self, index):
+        if index < 0:
+            return {}
+        chunk_no, offset = divmod(index, self.CHUNK_SLICES)
+        states = self.chunks.get(chunk_no)
+        if states is None:
+            # Not prefetched (yet), e.g. right after a seek
+            self.misses += 1
+            states = self.load_chunk(chunk_no)
+        if chunk_no != self.chunk:
+            self.chunk = chunk_no
+            self.wanted.set()
+        return states[offset]
+
+    def diff(self, from_index, to_index):
+        # Equal specs from two different chunks are separate objects
+        return self.changes_between(self.state_at(from_index), self.state_at(to_index), self.equivalent)
+
+    def get(self, key, default=None):
+        """Returns the effective state of the slice starting at tick `key`.
+
+        Unlike `Timeline`, the slices as written in the source are not kept.
+        """
+        index = self.index_at(key)
+        if index < 0 or self.ticks[index] != key:
+            return default
+        return self.state_at(index)
+
+    def __len__(self):
+        return len(self.ticks)
+
+    def __setitem__(self, key, item):
+        raise TypeError("Streaming timelines are read-only")
+
+    def __getitem__(self, key):
+        state = self.get(key)
+        if state is None:
+            raise KeyError(key)
+        return state
+
+    def __delitem__(self, key):
+        raise TypeError("Streaming timelines are read-only")
+
+    def close(self):
+        self.running = False
+        self.wanted.set()
+        # The prefetch thread may be in the middle of reading a chunk
+        self.prefetcher.join()
+        self.file.close()
+
 
 ### Action Classes ###
 
@@ -237,7 +1388,7 @@ class ClockForwardAction(NoteAction):
             self.step = max(step, 1)
 
     def execute(self, state):
-        if state == ButtonState.ACTIVE and not CLOCK.warping:
+        if state == ButtonState.ACTIVE:
             CLOCK.warp(self.step)
             print(f"Warped forward by {self.step} ticks")
 
@@ -251,27 +1402,260 @@ class ClockRewindAction(NoteAction):
             self.step = max(step, 1)
 
     def execute(self, state):
-        if state == ButtonState.ACTIVE and not CLOCK.warping:
+        if state == ButtonState.ACTIVE:
             CLOCK.warp(self.step, reverse=True)
             print(f"Warped backward by {self.step} ticks")
 
 
+### Animation Classes ###
+
+class Animation(ABC):
+    """A procedural LED pattern over the 8x8 pad grid.
+
+    Frames are `bytes` holding one velocity per pad, row by row from pad 0, with
+    `TRANSPARENT` for pads that keep showing their own state. A new frame is
+    rendered every `step` ticks, in between the same frame object is returned.
+    """
+
+    TRANSPARENT = 0xFF
+    BLANK = bytes((TRANSPARENT,)) * 64
+    ORDERS = {
+        "rows": tuple(range(64)),
+        "columns": tuple(row * 8 + column for column in range(8) for row in range(8)),
+    }
+
+    def __init__(self, colors="orange", state="bright", step=1, duration=None, order="rows", palette=None):
+        if isinstance(colors, str):
+            colors = colors.split()
+        if order not in self.ORDERS:
+            raise ValueError(f"Unknown animation order {order!r}, expected one of {tuple(self.ORDERS)}")
+        self.colors = bytes(LedState(color, state).color_value(palette) for color in colors)
+        self.dim_colors = bytes(LedState(color, "dim").color_value(palette) for color in colors)
+        self.step = max(int(step), 1)
+        self.duration = duration
+        self.order = self.ORDERS[order]
+        self.last = (None, None)
+
+    def frame(self, t):
+        """Returns the frame `t` ticks into the animation, or None once it is over."""
+        if self.duration is not None and t >= self.duration:
+            return None
+        step = t // self.step
+        last_step, frame = self.last
+        if step != last_step:
+            frame = self.render(step)
+            self.last = (step, frame)
+        return frame
+
+    @abstractmethod
+    def render(self, step):
+        pass
+
+
+class FillAnimation(Animation):
+    """Lights `group` more pads every step, in `order`, until the grid is full."""
+
+    def __init__(self, group=1, **kwargs):
+        super().__init__(**kwargs)
+        self.group = group
+
+    def render(self, step):
+        frame = bytearray(self.BLANK)
+        colors = self.colors
+        for i, pad in enumerate(self.order[:(step + 1) * self.group]):
+            frame[pad] = colors[i % len(colors)]
+        return bytes(frame)
+
+
+class SweepAnimation(Animation):
+    """Moves a bar `width` rows (or columns) wide across the grid, changing color every pass."""
+
+    def __init__(self, width=1, **kwargs):
+        super().__init__(**kwargs)
+        self.width = width
+
+    def render(self, step):
+        frame = bytearray(self.BLANK)
+        color = self.colors[step // 8 % len(self.colors)]
+        for line in range(step, step + self.width):
+            start = line % 8 * 8
+            for pad in self.order[start:start + 8]:
+                frame[pad] = color
+        return bytes(frame)
+
+
+class ChaseAnimation(Animation):
+    """Runs a tail of `length` pads through the grid in `order`, wrapping around."""
+
+    def __init__(self, length=4, **kwargs):
+        super().__init__(**kwargs)
+        self.length = length
+
+    def render(self, step):
+        frame = bytearray(self.BLANK)
+        colors = self.colors
+        for i in range(self.length):
+            frame[self.order[(step - i) % 64]] = colors[i % len(colors)]
+        return bytes(frame)
+
+
+class FadeAnimation(Animation):
+    """Pulses the whole grid between the dim and bright state of each color in turn."""
+
+    def render(self, step):
+        index = step // 2 % len(self.colors)
+        color = self.colors[index] if step % 2 else self.dim_colors[index]
+        return bytes((color,)) * 64
+
+
+ANIMATIONS = {
+    "fill": FillAnimation,
+    "sweep": SweepAnimation,
+    "chase": ChaseAnimation,
+    "fade": FadeAnimation,
+}
+
+
+class Animator(threading.Thread):
+    """Paints the animations of a jam's timeline over its pads.
+
+    Frames are rendered up to `lookahead` ticks ahead of the clock on a thread of
+    their own, so a tick only diffs the frame against the one shown before and
+    sends the pads that changed. Without lookahead, or when a seek outran it,
+    the frame is rendered on the spot.
+    """
+
+    def __init__(self, jam, lookahead=8):
+        super().__init__(name="animator", daemon=True)
+        self.jam = jam
+        self.lookahead = lookahead
+        # Rendered ahead, tick -> (animation, frame)
+        self.frames = {}
+        self.tick_no = 0
+        self.wakeup = threading.Event()
+        self.running = True
+        self.shown = None
+        # The last painted (tick, animation, frame), a paused clock paints the same tick again
+        self.painted = None
+        self.rendered = 0
+        self.misses = 0
+        if lookahead:
+            self.start()
+
+    def animation_at(self, tick_no):
+        timeline = self.jam.timeline
+        return timeline.animation_at(tick_no) if timeline else None
+
+    def run(self):
+        next_tick = None
+        while self.running:
+            self.wakeup.wait()
+            self.wakeup.clear()
+            base = self.tick_no
+            last = base + self.lookahead
+            if next_tick is None or not base < next_tick <= last + 1:
+                # Started, or the clock jumped
+                next_tick = base + 1
+            for tick_no in list(self.frames):
+                if not base < tick_no <= last:
+                    self.frames.pop(tick_no, None)
+            while next_tick <= last and self.running:
+                start, animation = self.animation_at(next_tick) or (0, None)
+                if animation:
+                    self.frames[next_tick] = (animation, animation.frame(next_tick - start))
+                    self.rendered += 1
+                next_tick += 1
+
+    def paint(self, tick_no, ticked):
+        """Sends the pads that changed since the last frame, `ticked` are the controls ticked just now."""
+        start, animation = self.animation_at(tick_no) or (0, None)
+        ahead = self.frames.pop(tick_no, None)
+        painted = self.painted
+        if ahead and ahead[0] is animation:
+            frame = ahead[1]
+        elif painted and painted[0] == tick_no and painted[1] is animation:
+            frame = painted[2]
+        else:
+            frame = animation.frame(tick_no - start) if animation else None
+            if animation:
+                self.misses += 1
+        self.painted = (tick_no, animation, frame)
+        if self.lookahead:
+            self.tick_no = tick_no
+            self.wakeup.set()
+
+        send = self.jam.leds.send_bytes
+        transparent = Animation.TRANSPARENT
+        shown = self.shown
+        if frame is not shown and frame != shown:
+            grid = self.jam.grid
+            for pad, (old, new) in enumerate(zip(shown or Animation.BLANK, frame or Animation.BLANK)):
+                if new != old:
+                    if new == transparent:
+                        # Back to what the pad shows by itself
+                        button = grid[pad]
+                        send(button.frames[button.state][0])
+                    else:
+                        send(bytes((NOTE_ON, pad, new)))
+            self.shown = frame
+
+        if frame is not None:
+            # Pads repainted by their buttons this tick, the animation stays on top
+            for control in ticked:
+                if type(control) is Button and frame[control.note] != transparent:
+                    send(bytes((NOTE_ON, control.note, frame[control.note])))
+
+    def stop(self):
+        self.running = False
+        self.wakeup.set()
+
+
 ### Tickable Classes ###
 
 class Clock:
 
-    def __init__(self, bpm=120, ppq=24, locked=False):
-        self.bpm = bpm
+    LATE_POLICIES = ("catch_up", "skip", "stretch")
+
+    def __init__(self, bpm=120, ppq=24, locked=False, late_policy="catch_up", spin=0.001):
+        if late_policy not in self.LATE_POLICIES:
+            raise ValueError(f"Unknown late policy {late_policy!r}, expected one of {self.LATE_POLICIES}")
         self.ppq = ppq
-        self.started = False
-        self.next = time.time()
         self.tick_no = 0
-        self.tick_length = 60 / (self.bpm * self.ppq)
         self.registered_objects = []
-        self.registered_cues = []
-        self.cpu = CPU()
+        # Names the profiler reports registered objects by
+        self.names = {}
+        self.cues = CueScheduler()
         self.locked = locked
-        self.warping = False
+        # Ticks are scheduled at absolute offsets from `epoch` (in perf_counter_ns)
+        # so rounding errors and late wake-ups never accumulate
+        self.epoch = None
+        self.pulse = 0
+        self.late_policy = late_policy
+        self.spin_ns = int(spin * 1e9)
+        self.jitter = LatencyStats()
+        self.late_ticks = 0
+        self.skipped_ticks = 0
+        self.behind = False
+        self.metrics = None
+        self.profiler = None
+        self.set_bpm(bpm)
+
+    def set_bpm(self, bpm):
+        """Changes the tempo, keeping the next tick where it was already scheduled."""
+        if self.epoch is not None:
+            self.epoch = self.deadline(self.pulse)
+            self.pulse = 0
+        self.bpm = bpm
+        self.tick_length = 60 / (self.bpm * self.ppq)
+        if self.metrics:
+            self.metrics.update_intervals()
+        # Tick period as an exact fraction of nanoseconds (milli-BPM resolution)
+        self.period_num = 60 * 10 ** 12
+        self.period_den = round(bpm * 1000) * self.ppq
+
+    def deadline(self, pulse):
+        """Returns the perf_counter_ns time at which `pulse` ticks after the epoch are due."""
+        return self.epoch + pulse * self.period_num // self.period_den
 
     def seconds_to_ticks(self, seconds):
         return seconds / self.tick_length
@@ -279,42 +1663,82 @@ class Clock:
     def ticks_to_seconds(self, ticks):
         return ticks * self.tick_length
 
-    def register(self, obj):
+    def register(self, obj, name=None):
+        self.names[obj] = name or f"{type(obj).__name__} {len(self.registered_objects)}"
         self.registered_objects.append(obj)
 
-    def register_cue(self, when, func, args, absolute=False):
-        if absolute:
-            self.registered_cues.append((when, func, args))
-        else:
-            self.registered_cues.append((self.tick_no + when, func, args))
+    def register_cue(self, when, func, args=(), absolute=False, every=None):
+        """Schedules `func(*args)` to run on tick `when` (relative to now unless `absolute`).
+
+        If `every` is given the cue is re-armed `every` ticks after each time it fires.
+        Returns a `Cue` handle that can be used to cancel it.
+        """
+        if not absolute:
+            when += self.tick_no
+        return self.cues.schedule(when, func, args, every=every)
 
     def warp(self, step, reverse=False):
-        self.warping = True
-        for i in range(step):
-            self.tick()
-            if reverse:
-                self.tick_no -= 1
-                if self.tick_no < 0:
-                    self.tick_no = 0
-                    break
-            else:
-                self.tick_no += 1
-        self.warping = False
+        self.seek(self.tick_no - step if reverse else self.tick_no + step)
+
+    def seek(self, tick_no):
+        """Jumps straight to `tick_no`, the next tick renders the state of the timeline there."""
+        self.tick_no = max(tick_no, 0)
 
     def tick(self):
         """Ticks the state of the application."""
-        expired_cues = [cue for cue in self.registered_cues if cue[0] <= self.tick_no]
-
-        for when, func, args in expired_cues:
-            func(*args)
-
-        for cue in expired_cues:
-            self.registered_cues.remove(cue)
+        self.cues.run_due(self.tick_no)
 
         for obj in self.registered_objects:
             obj.tick(self.tick_no)
 
-        self.cpu.tick(self.tick_no)
+    def run_offline(self, ticks):
+        """Runs `ticks` ticks back-to-back, as fast as possible instead of in real time."""
+        for _ in range(ticks):
+            self.tick()
+            if not self.locked:
+                self.tick_no += 1
+            self.pulse += 1
+
+    def instrument(self, metrics):
+        """Starts feeding tick durations to `metrics`, or stops if it is None."""
+        self.metrics = metrics
+        self.select_tick()
+
+    def profile(self, profiler):
+        """Starts timing every registered object and `NoteAction` with `profiler`, or stops if it is None."""
+        self.profiler = profiler
+        self.select_tick()
+
+    def select_tick(self):
+        # Swapping the bound `tick` keeps an uninstrumented clock free of any per-tick overhead
+        if self.metrics:
+            self.tick = self.instrumented_tick
+        elif self.profiler:
+            self.tick = self.profiled_tick
+        else:
+            self.__dict__.pop("tick", None)
+
+    def instrumented_tick(self):
+        start = time.perf_counter_ns()
+        if self.profiler:
+            self.profiled_tick()
+        else:
+            Clock.tick(self)
+        self.metrics.tick(time.perf_counter_ns() - start)
+
+    def profiled_tick(self):
+        tick_no = self.tick_no
+        start = time.perf_counter_ns()
+        self.cues.run_due(tick_no)
+        now = time.perf_counter_ns()
+        spans = [("cues", start, now)]
+        names = self.names
+        for obj in self.registered_objects:
+            obj.tick(tick_no)
+            end = time.perf_counter_ns()
+            spans.append((names[obj], now, end))
+            now = end
+        self.profiler.record_tick(tick_no, spans)
 
     def lock(self):
         self.locked = True
@@ -328,235 +1752,1100 @@ class Clock:
     # Return how long it is until the next tick.
     # (Or zero if the next tick is due now, or overdue.)
     def poll(self):
-        now = time.time()
-        if now < self.next:
-            return self.next - now
+        now = time.perf_counter_ns()
+        if self.epoch is None:
+            self.epoch = now
+            self.pulse = 0
+
+        due = self.deadline(self.pulse)
+        if now < due:
+            return (due - now) / 1e9
+
+        lateness = now - due
+        if self.metrics:
+            self.jitter.record(lateness)
+
+        # Have we missed at least one whole tick?
+        if now >= self.deadline(self.pulse + 1):
+            if not self.behind:
+                print("We're running late by {:.2f} ms!".format(lateness / 1e6))
+            self.behind = True
+            self.late_ticks += 1
+            if self.late_policy == "skip":
+                # Drop the ticks we missed, staying aligned to wall clock time
+                missed = (now - self.epoch) * self.period_den // self.period_num - self.pulse
+                self.pulse += missed
+                self.skipped_ticks += missed
+                if not self.locked:
+                    self.tick_no += missed
+            elif self.late_policy == "stretch":
+                # Shift the whole grid so that this tick is on time
+                self.epoch += lateness
+            # With "catch_up" every missed tick is played back-to-back until we are on time again
+        else:
+            self.behind = False
+
         self.tick()
         if not self.locked:
             self.tick_no += 1
-        # Compute when we're due next
-        self.next += 60.0 / self.bpm / 24
-        if now > self.next:
-            if self.started:
-                print("We're running late by {:.2f} seconds!".format(self.next - now))
-            # If we are late, should we try to stay aligned, or skip?
-            margin = 0.0  # Put 1.0 for pseudo-realtime
-            if now > self.next + margin:
-                if self.started:
-                    print("Catching up (deciding that next tick = now).")
-                self.next = now
-            return 0
-        self.started = True
-        return self.next - now
+        self.pulse += 1
+
+        return max(self.deadline(self.pulse) - time.perf_counter_ns(), 0) / 1e9
+
+    def wait_until(self, deadline):
+        """Sleeps until shortly before `deadline` (perf_counter_ns), then spins for the rest."""
+        remaining = deadline - time.perf_counter_ns()
+        if remaining > self.spin_ns:
+            time.sleep((remaining - self.spin_ns) / 1e9)
+        while time.perf_counter_ns() < deadline:
+            pass
 
     # Wait until next tick is due.
     def once(self):
-        time.sleep(self.poll())
+        if self.poll() > 0:
+            self.wait_until(self.deadline(self.pulse))
+
+
+class ExternalClock(Clock):
+    """Clock following MIDI Clock, Start/Stop/Continue and Song Position Pointer from an input port.
+
+    Incoming clocks (24 per quarter note) are tracked by a simple phase locked
+    loop that smooths out the jitter of the MIDI connection, both in the tempo
+    and in the position of each clock. Ticks are interpolated in between when
+    `ppq` is not 24, but never run ahead of the next expected clock. While the
+    master is stopped (or has gone quiet) ticks keep coming at the last known
+    tempo with the timeline paused, so input is still handled.
+    """
+
+    MIDI_PPQ = 24
+
+    def __init__(self, bpm=120, ppq=24, late_policy="catch_up", spin=0.001, smoothing=0.1, timeout=0.5):
+        super().__init__(bpm, ppq, locked=True, late_policy=late_policy, spin=spin)
+        self.smoothing = smoothing
+        self.timeout_ns = int(timeout * 1e9)
+        # Filled from the MIDI input thread, drained by the clock thread
+        self.events = deque()
+        self.wakeup = threading.Event()
+        self.playing = False
+        self.lost = False
+        # Clocks received since the last start or position change, the first one is clock 0
+        self.clocks = -1
+        # Length of one incoming clock and the (smoothed) time of the last one, in nanoseconds
+        self.clock_period = round(60e9 / (bpm * self.MIDI_PPQ))
+        self.last_clock = None
+        self.last_received = None
+        # Last sign of life from the master while playing, to notice it going away
+        self.last_heard = None
+        self.sync_error = LatencyStats()
+        self.set_clock_period(self.clock_period)
+
+    @property
+    def tempo(self):
+        """The tempo of the master in BPM, as currently estimated."""
+        return 60e9 / (self.clock_period * self.MIDI_PPQ)
+
+    def attach(self, port):
+        port.callback = self.receive
+
+    def receive(self, message):
+        # Runs on the MIDI input thread, stamp it right away and leave the rest to the clock thread
+        self.events.append((time.perf_counter_ns(), message))
+        self.wakeup.set()
+
+    def set_clock_period(self, clock_period):
+        if not self.playing and self.epoch is not None:
+            # Free running, keep the next tick where it was already scheduled
+            self.epoch = self.deadline(self.pulse)
+            self.pulse = 0
+        self.clock_period = clock_period
+        # One tick is 24 / ppq incoming clocks
+        self.period_num = clock_period * self.MIDI_PPQ
+        self.period_den = self.ppq
+
+    def sync(self):
+        """Applies everything received from the master since the last call."""
+        while self.events:
+            stamp, message = self.events.popleft()
+            kind = message.type
+            if kind == "clock":
+                self.on_clock(stamp)
+            elif kind == "start":
+                self.position(0)
+                self.play()
+            elif kind == "continue":
+                self.play()
+            elif kind == "stop":
+                self.halt()
+            elif kind == "songpos":
+                # Song position is counted in 16th notes, 6 clocks each
+                self.position(message.pos * 6)
+
+    def on_clock(self, stamp):
+        if self.lost:
+            print(colored("External clock", "green"), "is back")
+            self.play()
+        self.clocks += 1
+
+        if self.last_received is not None:
+            interval = stamp - self.last_received
+            # Anything much longer than a clock is a pause, not a tempo change
+            if interval < 4 * self.clock_period:
+                self.set_clock_period(round(self.clock_period + self.smoothing * (interval - self.clock_period)))
+        self.last_received = self.last_heard = stamp
+
+        predicted = None if self.last_clock is None else self.last_clock + self.clock_period
+        if predicted is None or abs(stamp - predicted) > self.clock_period // 2:
+            # Nothing to go on, or way off (e.g. after a pause), snap to the clock as received
+            self.last_clock = stamp
+        else:
+            self.sync_error.record(abs(stamp - predicted))
+            self.last_clock = predicted + (stamp - predicted) // 2
+
+        if self.playing:
+            # Line up the tick grid so that clock number `clocks` lands on `last_clock`
+            self.epoch = self.last_clock - self.clocks * self.clock_period
+
+    def position(self, clocks):
+        """Moves to the song position `clocks` MIDI clocks from the start."""
+        self.seek(clocks * self.ppq // self.MIDI_PPQ)
+        if not self.playing and self.epoch is not None:
+            # Free running, keep the next tick where it was already scheduled instead of catching up
+            self.epoch = self.deadline(self.pulse)
+        self.clocks = -1
+        self.pulse = 0
+
+    def play(self):
+        self.playing = True
+        self.lost = False
+        self.clocks = -1
+        self.pulse = 0
+        self.last_heard = time.perf_counter_ns()
+        self.unlock()
+
+    def halt(self, lost=False):
+        self.playing = False
+        self.lost = lost
+        self.lock()
+        self.epoch = time.perf_counter_ns()
+        self.pulse = 0
+
+    def wait_until(self, deadline):
+        """Like `Clock.wait_until`, but returns early when something arrives from the master."""
+        remaining = deadline - time.perf_counter_ns()
+        if remaining > self.spin_ns and self.wakeup.wait((remaining - self.spin_ns) / 1e9):
+            return
+        while time.perf_counter_ns() < deadline:
+            pass
+
+    def poll(self):
+        self.wakeup.clear()
+        self.sync()
+        if self.playing:
+            if time.perf_counter_ns() - self.last_heard > self.timeout_ns:
+                print(colored("Warning:", "yellow"), "Lost the external clock, pausing")
+                self.halt(lost=True)
+            elif self.pulse * self.MIDI_PPQ >= (self.clocks + 1) * self.ppq:
+                # Caught up with the master, wait for its next clock
+                return self.clock_period / 1e9
+        return super().poll()
 
+    def once(self):
+        delay = self.poll()
+        if delay > 0:
+            self.wait_until(time.perf_counter_ns() + int(delay * 1e9))
 
-class CPU(Tickable):
 
-    def __init__(self, report_interval=10):
-        self.last_usage = 0
-        self.last_time = 0
-        self.last_shown = 0
+def elevate_priority(priority):
+    """Switches the calling thread to real-time (SCHED_FIFO) scheduling at `priority`."""
+    if not hasattr(os, "sched_setscheduler"):
+        print(colored("Warning:", "yellow"), "Real-time scheduling is only supported on Linux")
+        return
+    try:
+        # On Linux this only affects the calling thread
+        os.sched_setscheduler(0, os.SCHED_FIFO, os.sched_param(priority))
+    except (PermissionError, OSError) as e:
+        print(colored("Warning:", "yellow"), f"Could not switch the clock to real-time priority: {e}")
+
+
+class ClockThread(threading.Thread):
+    """Runs the clock on its own thread, optionally at real-time scheduling priority."""
+
+    def __init__(self, clock, priority=None):
+        super().__init__(name="clock", daemon=True)
+        self.clock = clock
+        self.priority = priority
+        self.running = True
+        self.error = None
+
+    def run(self):
+        if self.priority is not None:
+            elevate_priority(self.priority)
+        try:
+            while self.running:
+                self.clock.once()
+        except Exception as e:
+            self.error = e
+            raise
+
+    def stop(self):
+        self.running = False
+        self.join()
+
+
+class AsyncRunner:
+    """Runs the clock on an asyncio event loop instead of a thread of its own.
+
+    Ticks are scheduled on the loop and MIDI input is bridged into an
+    `asyncio.Queue`, so everything registered on the clock (and everything it
+    sends) runs on the loop thread, and other I/O like a control socket can be
+    added as plain tasks. Like `Clock.once` it sleeps until shortly before each
+    tick and spins for the rest, which blocks the loop for up to `spin`.
+    """
+
+    def __init__(self, clock, priority=None):
+        self.clock = clock
+        self.priority = priority
+        self.running = True
+        self.ports = []
+        self.loop = None
+        self.inbox = None
+        self.waiter = None
+
+    def bridge(self, port, handler):
+        """Delivers the messages of `port` to `handler` on the loop instead of the MIDI input thread."""
+        self.ports.append((port, handler))
+
+    async def dispatch(self):
+        while True:
+            handler, message = await self.inbox.get()
+            handler(message)
+            # Wake the clock, the message may make a tick due early (e.g. an external clock)
+            self.wake()
+
+    def wake(self):
+        if self.waiter and not self.waiter.done():
+            self.waiter.set_result(None)
+
+    async def sleep(self, delay):
+        """Sleeps for `delay` seconds, or until the next message has been dispatched."""
+        deadline = time.perf_counter_ns() + int(delay * 1e9)
+        # Selector timeouts are rounded up to whole milliseconds, leave room for that too
+        coarse = delay - self.clock.spin_ns / 1e9 - 0.001
+        if coarse > 0:
+            self.waiter = self.loop.create_future()
+            timer = self.loop.call_later(coarse, self.wake)
+            await self.waiter
+            timer.cancel()
+            if deadline - time.perf_counter_ns() > self.clock.spin_ns:
+                return
+        while time.perf_counter_ns() < deadline:
+            pass
+
+    async def run(self):
+        import asyncio
+
+        if self.priority is not None:
+            elevate_priority(self.priority)
+        self.loop = asyncio.get_running_loop()
+        self.inbox = asyncio.Queue()
+        for port, handler in self.ports:
+            def receive(message, handler=handler):
+                self.loop.call_soon_threadsafe(self.inbox.put_nowait, (handler, message))
+            port.callback = receive
+        dispatcher = asyncio.create_task(self.dispatch())
+        try:
+            while self.running:
+                delay = self.clock.poll()
+                if delay > 0:
+                    await self.sleep(delay)
+                else:
+                    # Catching up, still give other tasks a turn between ticks
+                    await asyncio.sleep(0)
+        finally:
+            dispatcher.cancel()
+            # The loop is going away, hand the ports back to the MIDI input thread
+            for port, handler in self.ports:
+                port.callback = handler
+
+    def stop(self):
+        self.running = False
+
+
+class Reloader(threading.Thread):
+    """Watches the timeline, palette and notes files and recompiles them in the background.
+
+    `devices` pairs each `MaschineJam` with the file of its timeline (or None).
+    The results are handed to `MaschineJam.reload`, the clock thread swaps them in
+    between two ticks. Files are polled, which needs no extra dependencies.
+    Timelines the devices let go of are released here too, closing a streaming
+    timeline joins its prefetch thread, which must not hold up a tick.
+    """
+
+    def __init__(self, devices, palette_file, notes_file, cache=True, interval=0.5, timeline_class=None):
+        super().__init__(name="reloader", daemon=True)
+        self.devices = devices
+        self.palette_file = palette_file
+        self.notes_file = notes_file
+        self.cache = cache
+        self.timeline_class = timeline_class or Timeline
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.mtimes = self.stat()
+
+    def stat(self):
+        mtimes = {}
+        for filename in [timeline_file for _, timeline_file in self.devices] + [self.palette_file, self.notes_file]:
+            if filename:
+                try:
+                    mtimes[filename] = os.stat(filename).st_mtime_ns
+                except OSError:
+                    mtimes[filename] = None
+        return mtimes
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.release_retired()
+            mtimes = self.stat()
+            changed = {filename for filename, mtime in mtimes.items() if mtime != self.mtimes.get(filename)}
+            if changed:
+                self.mtimes = mtimes
+                self.reload(changed)
+        self.release_retired()
+
+    def release_retired(self):
+        for jam, _ in self.devices:
+            retired = jam.retired
+            while retired:
+                retired.popleft().release()
+
+    def reload(self, changed):
+        # Parsing holds the GIL, switching threads more often keeps the clock thread on time meanwhile.
+        # It also allocates a lot of objects, which would trigger full garbage collections that stall
+        # every thread for hundreds of milliseconds, so collection is paused while parsing. The result
+        # is not frozen, the timeline it replaces has to stay collectable once it is retired.
+        switch_interval = sys.getswitchinterval()
+        sys.setswitchinterval(min(switch_interval, 0.0005))
+        gc.disable()
+        try:
+            palette = Palette(self.palette_file, cache=self.cache) if self.palette_file in changed else PALETTE
+            note_db = NoteDB(self.notes_file, cache=self.cache) if self.notes_file in changed else NOTE_DB
+            # Timelines are compiled against the tables, so all of them are rebuilt if those changed
+            tables_changed = palette is not PALETTE or note_db is not NOTE_DB
+            timelines = {}
+            for _, timeline_file in self.devices:
+                if timeline_file and (tables_changed or timeline_file in changed) and timeline_file not in timelines:
+                    timelines[timeline_file] = self.timeline_class(timeline_file, cache=self.cache,
+                                                                   palette=palette, note_db=note_db)
+        except Exception as e:
+            # Keep playing what we have, the file is probably only half edited
+            print(colored("Error:", "red"), f"Could not reload {', '.join(sorted(changed))}: {e}")
+            return
+        finally:
+            gc.enable()
+            sys.setswitchinterval(switch_interval)
+        for jam, timeline_file in self.devices:
+            timeline = timelines.get(timeline_file)
+            if timeline or tables_changed:
+                if timeline:
+                    # Held by the device from here on, even if it never gets to swap it in
+                    timeline.acquire()
+                replaced = jam.reload(timeline, palette, note_db)
+                if replaced and replaced[0]:
+                    replaced[0].release()
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+
+class Metrics:
+    """Collects runtime statistics for the clock and everything registered on it.
+
+    Tick durations go into a ring buffer, resource usage is only sampled every
+    `sample_interval` seconds and a summary is printed (and optionally dumped as
+    JSON) every `report_interval` seconds. All intervals are counted in ticks so
+    the per-tick cost is a couple of integer operations.
+    """
+
+    def __init__(self, clock, report_interval=10, sample_interval=1, json_file=None):
+        self.clock = clock
         self.report_interval = report_interval
+        self.sample_interval = sample_interval
+        self.json_file = json_file
+        self.tick_time = LatencyStats()
+        self.ticks = 0
+        self.cpu_percent = 0.0
+        self.max_rss = 0
+        self.last_usage = self.cpu_time()
+        self.last_time = time.perf_counter()
+        self.update_intervals()
+
+    def update_intervals(self):
+        self.sample_every = max(round(self.sample_interval / self.clock.tick_length), 1)
+        # Without a report interval statistics are only collected
+        self.report_every = max(round(self.report_interval / self.clock.tick_length), 1) if self.report_interval else 0
+
+    @staticmethod
+    def cpu_time():
+        r = resource.getrusage(resource.RUSAGE_SELF)
+        return r.ru_utime + r.ru_stime
 
-    def tick(self, tick):
+    def sample(self):
         r = resource.getrusage(resource.RUSAGE_SELF)
         new_usage = r.ru_utime + r.ru_stime
-        new_time = time.time()
-        if new_time > self.last_shown + self.report_interval:
-            percent = ((new_usage - self.last_usage) / (new_time - self.last_time)) * 100
-            print("CPU usage: {}%".format(colored(f"{percent:.2f}", "red" if percent > 90 else "green")))
-            self.last_shown = new_time
+        new_time = time.perf_counter()
+        self.cpu_percent = (new_usage - self.last_usage) / (new_time - self.last_time) * 100
+        self.max_rss = r.ru_maxrss
         self.last_usage = new_usage
         self.last_time = new_time
 
+    def tick(self, duration):
+        self.tick_time.record(duration)
+        self.ticks += 1
+        if self.ticks % self.sample_every == 0:
+            self.sample()
+            if self.report_every and self.ticks % self.report_every == 0:
+                self.report()
+
+    def snapshot(self):
+        """Returns all statistics as a JSON serializable dict."""
+        data = {
+            "tick_no": self.clock.tick_no,
+            "ticks": self.ticks,
+            "cpu_percent": self.cpu_percent,
+            "max_rss": self.max_rss,
+            "tick_time": self.tick_time.summary(),
+            "lateness": self.clock.jitter.summary(),
+            "late_ticks": self.clock.late_ticks,
+            "skipped_ticks": self.clock.skipped_ticks,
+        }
+        for i, obj in enumerate(self.clock.registered_objects):
+            stats = getattr(obj, "stats", None)
+            if stats:
+                data[f"{type(obj).__name__.lower()}_{i}"] = stats()
+        if self.clock.profiler:
+            data["profile"] = self.clock.profiler.summary()
+        return data
+
+    def report(self):
+        color = "red" if self.cpu_percent > 90 else "green"
+        print("CPU usage: {}%, tick time {}, lateness p99 {:.3f} ms".format(
+            colored(f"{self.cpu_percent:.2f}", color), self.tick_time, self.clock.jitter.percentile(0.99) / 1e6))
+        if self.json_file:
+            self.dump(self.json_file)
+
+    def dump(self, filename):
+        import json
+
+        with open(filename, "w") as f:
+            json.dump(self.snapshot(), f, indent=2)
+
+
+class Profiler:
+    """Times every object the clock ticks and every `NoteAction` run, and watches the tick budget.
+
+    Ticks taking longer than `budget` seconds are logged, at most once per beat of wall time, with
+    the tick number, the timeline slice of each device and what took the longest.
+    With a `trace_file` every tick is also written out as Chrome trace events, which
+    chrome://tracing and Perfetto open.
+    """
+
+    def __init__(self, clock, budget=None, trace_file=None, top=3):
+        self.clock = clock
+        self.budget_ns = int(budget * 1e9) if budget else None
+        self.top = top
+        # Tick times by object name, `NoteAction` times by class
+        self.object_times = {}
+        self.action_times = {}
+        # Actions run during the current tick, as (name, start, end)
+        self.actions = []
+        self.over_budget = 0
+        self.unlogged = 0
+        self.last_logged_ns = None
+        self.trace = None
+        if trace_file:
+            import json
+
+            self.dumps = json.dumps
+            self.trace = open(trace_file, "w")
+            # The closing bracket is optional, a trace cut short still loads
+            self.trace.write("[\n")
+            self.trace_epoch = time.perf_counter_ns()
+            self.trace_ids = f'"pid": {os.getpid()}, "tid": {threading.get_ident()}'
+            self.quoted = {}
+
+    def record_action(self, action, start, end):
+        name = type(action).__name__
+        stats = self.action_times.get(name)
+        if stats is None:
+            stats = self.action_times[name] = LatencyStats()
+        stats.record(end - start)
+        self.actions.append((name, start, end))
+
+    def record_tick(self, tick_no, spans):
+        object_times = self.object_times
+        for name, start, end in spans:
+            stats = object_times.get(name)
+            if stats is None:
+                stats = object_times[name] = LatencyStats()
+            stats.record(end - start)
+
+        actions = self.actions
+        start, end = spans[0][1], spans[-1][2]
+        if self.trace:
+            self.write_trace(tick_no, start, end, spans, actions)
+        if self.budget_ns and end - start > self.budget_ns:
+            self.over_budget += 1
+            # Rate-limited on wall time, the tick number stands still while the clock is locked
+            clock = self.clock
+            beat_ns = clock.ppq * clock.period_num // clock.period_den
+            if self.last_logged_ns is None or end - self.last_logged_ns >= beat_ns:
+                self.log(tick_no, end - start, spans + actions)
+                self.last_logged_ns = end
+            else:
+                self.unlogged += 1
+        if actions:
+            self.actions = []
+
+    def log(self, tick_no, duration, spans):
+        offenders = sorted(spans, key=lambda span: span[2] - span[1], reverse=True)[:self.top]
+        slices = []
+        for obj in self.clock.registered_objects:
+            timeline = getattr(obj, "timeline", None)
+            if timeline is not None and obj.slice_index >= 0:
+                slices.append(f"{self.clock.names[obj]} in the slice at tick {timeline.ticks[obj.slice_index]}")
+        since = f", {self.unlogged} more since the last one" if self.unlogged else ""
+        print(colored("Warning:", "yellow"),
+              f"Tick {tick_no} took {duration / 1e6:.3f} ms, over the {self.budget_ns / 1e6:.3f} ms budget{since}. "
+              f"{'; '.join(slices) or 'No timeline'}. Slowest: "
+              + ", ".join(f"{name} {(end - start) / 1e6:.3f} ms" for name, start, end in offenders))
+        self.unlogged = 0
+
+    def write_trace(self, tick_no, start, end, spans, actions):
+        quoted = self.quoted
+        epoch = self.trace_epoch
+        ids = self.trace_ids
+        lines = [f'{{"name": "tick", "cat": "tick", "ph": "X", "ts": {(start - epoch) / 1e3}, '
+                 f'"dur": {(end - start) / 1e3}, {ids}, "args": {{"tick_no": {tick_no}}}}},\n']
+        for category, events in (("object", spans), ("action", actions)):
+            for name, start, end in events:
+                name = quoted.get(name) or quoted.setdefault(name, self.dumps(name))
+                lines.append(f'{{"name": {name}, "cat": "{category}", "ph": "X", "ts": {(start - epoch) / 1e3}, '
+                             f'"dur": {(end - start) / 1e3}, {ids}}},\n')
+        self.trace.write("".join(lines))
+
+    def summary(self):
+        return {
+            "over_budget": self.over_budget,
+            "objects": {name: stats.summary() for name, stats in self.object_times.items()},
+            "actions": {name: stats.summary() for name, stats in self.action_times.items()},
+        }
+
+    def report(self):
+        print("Tick profile:")
+        for name, stats in list(self.object_times.items()) + list(self.action_times.items()):
+            print(f"  {name}: {stats}")
+        if self.budget_ns:
+            print(f"  {self.over_budget} ticks over the {self.budget_ns / 1e6:.3f} ms budget")
+
+    def close(self):
+        if self.trace:
+            # A last event without the trailing comma makes it a valid JSON document
+            self.trace.write(f'{{"name": "end", "ph": "i", "s": "g", '
+                             f'"ts": {(time.perf_counter_ns() - self.trace_epoch) / 1e3}, {self.trace_ids}}}\n]\n')
+            self.trace.close()
+            self.trace = None
+
+
+class ClockOutput(Tickable):
+    """Sends MIDI Clock, Start/Stop/Continue and Song Position for the tick grid of `clock`.
+
+    Clocks go out at 24 per quarter note, on every tick that starts a new one,
+    and keep running while the clock is paused. Transport changes (pausing,
+    resetting, warping) are picked up on the next tick, a jump while playing is
+    sent as Stop, Song Position, Continue. Song Position only has a resolution
+    of a 16th note, the remaining clocks are sent right after Continue so the
+    receiver lands on the exact clock. Register it before anything else on the
+    clock, so its messages go out as close to the tick as possible.
+    """
+
+    MIDI_PPQ = 24
+    CLOCK_FRAME = bytes((TIMING_CLOCK,))
+    START_FRAME = bytes((START,))
+    CONTINUE_FRAME = bytes((CONTINUE,))
+    STOP_FRAME = bytes((STOP,))
+
+    def __init__(self, clock, send, port=None):
+        self.clock = clock
+        self.send = send
+        self.port = port
+        self.playing = False
+        self.last_tick = -1
+        # Position of the clock grid in ticks, follows `tick_no` while playing
+        self.pulses = 0
+        self.sent = 0
+        self.last_sent = None
+        self.last_deadline = None
+        # Send time of each clock vs. its tick deadline, and the error of the interval between two clocks,
+        # only measured while the clock is instrumented
+        self.lateness = LatencyStats()
+        self.interval_error = LatencyStats()
+
+    def stats(self):
+        return {
+            "clocks_sent": self.sent,
+            "lateness": self.lateness.summary(),
+            "interval_error": self.interval_error.summary(),
+        }
+
+    def clocks_before(self, tick_no):
+        """Number of clocks that start before `tick_no`."""
+        return -(-tick_no * self.MIDI_PPQ // self.clock.ppq)
+
+    def song_position(self, tick_no):
+        # In 16th notes, 6 clocks each, as a 14 bit value
+        position = min(self.clocks_before(tick_no) // 6, 0x3FFF)
+        return bytes((SONG_POSITION, position & 0x7F, position >> 7))
+
+    def start(self, tick_no):
+        clocks = self.clocks_before(tick_no)
+        if clocks < 6:
+            self.send(self.START_FRAME)
+        else:
+            self.send(self.song_position(tick_no))
+            self.send(self.CONTINUE_FRAME)
+        # The first clock after Start/Continue plays the song position, catch up to ours
+        for _ in range(clocks - clocks // 6 * 6):
+            self.send(self.CLOCK_FRAME)
+        self.pulses = tick_no
+
+    def tick(self, tick_no):
+        playing = not self.clock.locked
+        # Pausing and resuming may or may not advance the clock by a tick, depending on when it happens
+        if playing and self.playing:
+            jumped = tick_no != self.last_tick + 1
+        else:
+            jumped = tick_no not in (self.last_tick, self.last_tick + 1)
+        if self.playing and (jumped or not playing):
+            self.send(self.STOP_FRAME)
+        if playing and (jumped or not self.playing):
+            self.start(tick_no)
+        elif not playing and jumped:
+            self.send(self.song_position(tick_no))
+        self.playing = playing
+        self.last_tick = tick_no
+
+        for _ in range(self.clocks_before(self.pulses + 1) - self.clocks_before(self.pulses)):
+            self.send(self.CLOCK_FRAME)
+            self.sent += 1
+            if self.clock.metrics:
+                self.measure()
+        self.pulses += 1
+
+    def measure(self):
+        clock = self.clock
+        if clock.epoch is None:
+            # Running offline
+            return
+        now = time.perf_counter_ns()
+        deadline = clock.deadline(clock.pulse)
+        self.lateness.record(max(now - deadline, 0))
+        if self.last_sent is not None and deadline > self.last_deadline:
+            self.interval_error.record(abs((now - self.last_sent) - (deadline - self.last_deadline)))
+        self.last_sent = now
+        self.last_deadline = deadline
+
+    def close(self):
+        if self.playing:
+            self.send(self.STOP_FRAME)
+            self.playing = False
+        if self.port:
+            self.port.close()
+
 
 class TouchStrip(Tickable):
+    """A touch strip, relaying every value it receives in order.
+
+    Values are queued and relayed on the next tick, optionally paced through
+    `configure_input`. The LED feedback only ever shows the latest value.
+    """
+
+    __slots__ = ("device_port", "relay_port", "send_device", "send_relay", "note", "frames",
+                 "state", "prev_state", "relayed_value", "needs_tick", "pending", "rate", "deadband",
+                 "interpolate")
 
     def __init__(self, device_port, relay_port, note):
         self.device_port = device_port
         self.relay_port = relay_port
+        self.send_device = raw_sender(device_port)
+        self.send_relay = raw_sender(relay_port)
         self.note = note
+        # One precompiled control_change frame per possible value
+        self.frames = tuple(bytes((CONTROL_CHANGE, note, value)) for value in range(128))
         self.state = 0
         self.prev_state = 0
+        # The last value that went out to the relay port
+        self.relayed_value = None
         self.needs_tick = True
+        self.pending = deque()
+        self.rate = None
+        self.deadband = 0
+        self.interpolate = 0
+
+    def configure_input(self, rate=None, deadband=0, interpolate=0):
+        """Paces the relayed values to at most `rate` per tick, skips changes smaller than `deadband`
+        unless nothing follows them and fills in up to `interpolate` steps between values further apart."""
+        self.rate = rate
+        self.deadband = deadband
+        self.interpolate = interpolate
+
+    @property
+    def paced(self):
+        return self.rate is not None or self.deadband > 0 or self.interpolate > 0
 
     def reset(self):
         self.state = 0
-        self.pev_state = 0
+        self.prev_state = 0
+        self.relayed_value = None
         self.needs_tick = True
+        self.pending.clear()
 
     def tick(self, tick_no):
-        if not self.needs_tick and self.prev_state == self.state:
-            return
+        """Returns True while values are still waiting to be relayed."""
+        state = self.state
+        pending = self.pending
+        if not self.needs_tick and self.prev_state == state and not pending:
+            return False
+
+        frames = self.frames
+        if pending:
+            send_relay = self.send_relay
+            deadband = self.deadband
+            count = len(pending) if self.rate is None else min(self.rate, len(pending))
+            for _ in range(count):
+                value = pending.popleft()
+                # The last value of a burst always goes out, so the relay settles where the strip did
+                if deadband and pending and self.relayed_value is not None \
+                        and abs(value - self.relayed_value) < deadband:
+                    continue
+                send_relay(frames[value])
+                self.relayed_value = value
+        elif self.relayed_value != state:
+            self.send_relay(frames[state])
+            self.relayed_value = state
+
+        if self.needs_tick or self.prev_state != state:
+            self.send_device(frames[state])
+            self.prev_state = state
+        self.needs_tick = False
+        return bool(pending)
 
-        self.device_port.send(mido.Message("control_change", control=self.note,
-                                           value=self.state))
-        self.relay_port.send(mido.Message("control_change", control=self.note,
-                                          value=self.state))
+    def recompile(self):
+        # Strip frames only carry the strip value, they do not depend on the palette
+        pass
 
-        self.needs_tick = False
-        self.prev_state = self.state
+    def input_state(self, message):
+        # Paced strips are relayed on the clock thread, in order with what is still queued
+        return None if self.paced else message.value
+
+    def relay_frames(self, state):
+        return (self.frames[state],)
 
-    def update(self, message):
+    def update(self, message, relayed=False):
+        value = message.value
         self.needs_tick = True
-        self.state = message.value
+        self.state = value
+        if relayed:
+            self.relayed_value = value
+            return
+
+        pending = self.pending
+        if self.interpolate:
+            last = pending[-1] if pending else self.relayed_value
+            if last is not None and abs(value - last) > 1:
+                steps = min(abs(value - last) - 1, self.interpolate)
+                pending.extend(last + (value - last) * i // (steps + 1) for i in range(1, steps + 1))
+        pending.append(value)
 
 
 class CCButton(Tickable):
 
+    __slots__ = ("device_port", "relay_port", "send_device", "send_relay", "note", "state", "prev_state",
+                 "relayed_state", "needs_tick", "led_state", "note_output", "action", "frames")
+
     def __init__(self, device_port, relay_port, note,
                  led_state_inactive=None, led_state_active=None,
                  note_output=None, action=None):
         self.device_port = device_port
         self.relay_port = relay_port
+        self.send_device = raw_sender(device_port)
+        self.send_relay = raw_sender(relay_port)
         self.note = note
         self.state = ButtonState.INACTIVE
         self.prev_state = None
+        self.relayed_state = None
         self.needs_tick = True
         self.led_state = {}
+        self.configure(led_state_active, led_state_inactive, note_output, action)
+
+    @staticmethod
+    def compile_frames(note, led_state_active, led_state_inactive, note_output=None, channel=0, palette=None):
+        """Compiles the (device frame, relay frames) pair sent for each `ButtonState`."""
+        outputs = note_outputs(note_output) or (note,)
+        return tuple((bytes((CONTROL_CHANGE, note, led_state.color_value(palette))),
+                      tuple(bytes((CONTROL_CHANGE, output, value)) for output in outputs))
+                     for led_state, value in ((led_state_inactive, 0), (led_state_active, 127)))
+
+    def configure(self, led_state_active=None, led_state_inactive=None,
+                  note_output=None, action=None, channel=0, frames=None):
         self.led_state["inactive"] = led_state_inactive or LedState("black", "dim")
         self.led_state["active"] = led_state_active or LedState("black", "bright")
         self.note_output = note_output
         self.action = action
+        self.frames = frames or self.compile_frames(self.note, self.led_state["active"],
+                                                    self.led_state["inactive"], note_output)
+        self.needs_tick = True
 
     def reset(self):
         self.state = ButtonState.INACTIVE
         self.prev_state = None
-        self.needs_tick = True
-        self.led_state["inactive"] = LedState("black", "dim")
-        self.led_state["active"] = LedState("black", "bright")
-        self.note_output = None
-        self.action = None
+        self.relayed_state = None
+        self.configure()
+
+    def recompile(self):
+        """Recompiles the frames of the current configuration, e.g. after the palette changed."""
+        self.recolor(self.led_state["active"], self.led_state["inactive"],
+                     self.compile_frames(self.note, self.led_state["active"], self.led_state["inactive"],
+                                         self.note_output))
+
+    def recolor(self, led_state_active, led_state_inactive, frames):
+        """Swaps in frames that only differ in their LED colors.
+
+        The state and what was relayed are kept, only the LED shown for the current state is rewritten.
+        """
+        self.led_state["active"] = led_state_active
+        self.led_state["inactive"] = led_state_inactive
+        self.frames = frames
+        if self.prev_state is not None:
+            self.send_device(frames[self.prev_state][0])
 
     def tick(self, tick_no):
+        state = self.state
         # If the state has not change, there is no need to update
-        if not self.needs_tick and self.prev_state == self.state:
+        if not self.needs_tick and self.prev_state == state:
             return
 
         if self.action:
-            self.state = self.action(self.state)
-
-        if self.state == ButtonState.INACTIVE:
-            self.device_port.send(mido.Message("control_change", control=self.note,
-                                               value=self.led_state["inactive"].color_value()))
-            if self.note_output:
-                if isinstance(self.note_output, int):
-                    self.relay_port.send(mido.Message("control_change", control=self.note_output, value=0))
-                elif isinstance(self.note_output, tuple) or isinstance(self.note_output, list):
-                    for note in self.note_output:
-                        self.relay_port.send(mido.Message("control_change", control=note, value=0))
-            else:
-                self.relay_port.send(mido.Message("control_change", control=self.note, value=0))
-        elif self.state == ButtonState.ACTIVE:
-            self.device_port.send(mido.Message("control_change", control=self.note,
-                                               value=self.led_state["active"].color_value()))
-            if self.note_output:
-                if isinstance(self.note_output, int):
-                    self.relay_port.send(mido.Message("control_change", control=self.note_output, value=127))
-                elif isinstance(self.note_output, tuple) or isinstance(self.note_output, list):
-                    for note in self.note_output:
-                        self.relay_port.send(mido.Message("control_change", control=note, value=127))
-            else:
-                self.relay_port.send(mido.Message("control_change", control=self.note, value=127))
+            state = self.state = self.action(state)
 
-        self.needs_tick = False
-        self.prev_state = self.state
+        device_frame, relay_frames = self.frames[state]
+        self.send_device(device_frame)
+        # Skip the relay if the input thread already sent it for this state
+        if self.relayed_state != state:
+            send_relay = self.send_relay
+            for frame in relay_frames:
+                send_relay(frame)
 
-    def update(self, message):
-        self.needs_tick = True
+        self.needs_tick = False
+        self.prev_state = state
+        self.relayed_state = None
 
+    def input_state(self, message):
         if message.value == 0:
-            self.state = ButtonState.INACTIVE
+            return ButtonState.INACTIVE
         elif message.value == 127:
-            self.state = ButtonState.ACTIVE
+            return ButtonState.ACTIVE
+        return None
+
+    def relay_frames(self, state):
+        return self.frames[state][1]
+
+    def update(self, message, relayed=False):
+        self.needs_tick = True
+
+        state = self.input_state(message)
+        if state is not None:
+            self.state = state
+            if relayed:
+                self.relayed_state = state
 
 
 class Button(Tickable):
 
+    __slots__ = ("device_port", "relay_port", "send_device", "send_relay", "note", "state", "prev_state",
+                 "relayed_state", "needs_tick", "led_state", "note_output", "action", "channel", "frames")
+
     def __init__(self, device_port, relay_port, note,
                  led_state_inactive=None, led_state_active=None,
                  note_output=None, action=None, channel=0):
         self.device_port = device_port
         self.relay_port = relay_port
+        self.send_device = raw_sender(device_port)
+        self.send_relay = raw_sender(relay_port)
         self.note = note
         self.state = ButtonState.INACTIVE
         self.prev_state = None
+        self.relayed_state = None
         self.needs_tick = True
         self.led_state = {}
+        self.configure(led_state_active, led_state_inactive, note_output, action, channel)
+
+    @staticmethod
+    def compile_frames(note, led_state_active, led_state_inactive, note_output=None, channel=0, palette=None):
+        """Compiles the (device frame, relay frames) pair sent for each `ButtonState`."""
+        outputs = note_outputs(note_output)
+        return tuple((bytes((NOTE_ON, note, led_state.color_value(palette))),
+                      tuple(bytes((NOTE_ON | channel, output, velocity)) for output in outputs))
+                     for led_state, velocity in ((led_state_inactive, 0), (led_state_active, 127)))
+
+    def configure(self, led_state_active=None, led_state_inactive=None,
+                  note_output=None, action=None, channel=0, frames=None):
         self.led_state["inactive"] = led_state_inactive or LedState("black", "dim")
         self.led_state["active"] = led_state_active or LedState("black", "bright")
         self.note_output = note_output
         self.action = action
         self.channel = channel
+        self.frames = frames or self.compile_frames(self.note, self.led_state["active"],
+                                                    self.led_state["inactive"], note_output, channel)
+        self.needs_tick = True
 
     def reset(self):
         self.state = ButtonState.INACTIVE
         self.prev_state = None
-        self.needs_tick = True
-        self.led_state["inactive"] = LedState("black", "dim")
-        self.led_state["active"] = LedState("black", "bright")
-        self.note_output = None
-        self.action = None
+        self.relayed_state = None
+        self.configure(channel=self.channel)
+
+    def recompile(self):
+        """Recompiles the frames of the current configuration, e.g. after the palette changed."""
+        self.recolor(self.led_state["active"], self.led_state["inactive"],
+                     self.compile_frames(self.note, self.led_state["active"], self.led_state["inactive"],
+                                         self.note_output, self.channel))
+
+    def recolor(self, led_state_active, led_state_inactive, frames):
+        """Swaps in frames that only differ in their LED colors.
+
+        The state and what was relayed are kept, only the LED shown for the current state is rewritten.
+        """
+        self.led_state["active"] = led_state_active
+        self.led_state["inactive"] = led_state_inactive
+        self.frames = frames
+        if self.prev_state is not None:
+            self.send_device(frames[self.prev_state][0])
 
     def tick(self, tick_no):
+        state = self.state
         # If the state has not change, there is no need to update
-        if not self.needs_tick and self.prev_state == self.state:
+        if not self.needs_tick and self.prev_state == state:
             return
 
         if self.action:
-            self.state = self.action(self.state)
-
-        if self.state == ButtonState.INACTIVE:
-            self.device_port.send(mido.Message("note_on", note=self.note,
-                                               velocity=self.led_state["inactive"].color_value()))
-            if self.note_output:
-                if isinstance(self.note_output, int):
-                    self.relay_port.send(mido.Message("note_on", channel=self.channel,
-                                                      note=self.note_output, velocity=0))
-                elif isinstance(self.note_output, tuple) or isinstance(self.note_output, list):
-                    for note in self.note_output:
-                        self.relay_port.send(mido.Message("note_on", channel=self.channel,
-                                                          note=note, velocity=0))
-        elif self.state == ButtonState.ACTIVE:
-            self.device_port.send(mido.Message("note_on", note=self.note,
-                                               velocity=self.led_state["active"].color_value()))
-            if self.note_output:
-                if isinstance(self.note_output, int):
-                    self.relay_port.send(mido.Message("note_on", channel=self.channel,
-                                                      note=self.note_output, velocity=127))
-                elif isinstance(self.note_output, tuple) or isinstance(self.note_output, list):
-                    for note in self.note_output:
-                        self.relay_port.send(mido.Message("note_on", channel=self.channel,
-                                                          note=note, velocity=127))
+            state = self.state = self.action(state)
 
-        self.needs_tick = False
-        self.prev_state = self.state
+        device_frame, relay_frames = self.frames[state]
+        self.send_device(device_frame)
+        # Skip the relay if the input thread already sent it for this state
+        if self.relayed_state != state:
+            send_relay = self.send_relay
+            for frame in relay_frames:
+                send_relay(frame)
 
-    def update(self, message):
-        self.needs_tick = True
+        self.needs_tick = False
+        self.prev_state = state
+        self.relayed_state = None
 
+    def input_state(self, message):
         if message.velocity == 0:
-            self.state = ButtonState.INACTIVE
+            return ButtonState.INACTIVE
         elif message.velocity == 127:
-            self.state = ButtonState.ACTIVE
+            return ButtonState.ACTIVE
+        return None
+
+    def relay_frames(self, state):
+        return self.frames[state][1]
+
+    def update(self, message, relayed=False):
+        self.needs_tick = True
+
+        state = self.input_state(message)
+        if state is not None:
+            self.state = state
+            if relayed:
+                self.relayed_state = state
 
 
 class MaschineJam(Tickable):
 
-    def __init__(self, port_name_in, port_name_out, port_name_relay):
+    def __init__(self, port_name_in, port_name_out, port_name_relay, max_pending_inputs=1024,
+                 immediate_relay=False, instrument=False, send_thread=False, animation_lookahead=8,
+                 relay_budget=None, relay_capacity=1024, strip_input=None, backend=None):
         super().__init__()
-        self.port_in = mido.open_input(port_name_in)
-        self.port_out = mido.open_output(port_name_out)
-        self.relay_port = mido.open_output(port_name_relay, virtual=True)
+        # Anything providing mido's open_input/open_output, e.g. a `MockBackend`
+        if backend is None:
+            import mido
+            backend = mido
+        self.port_in = backend.open_input(port_name_in)
+        self.port_out = backend.open_output(port_name_out)
+        self.relay_port = backend.open_output(port_name_relay, virtual=True)
+        # Optionally write to the device and relay port from a thread of our own
+        self.sender = None
+        device, relay = self.port_out, self.relay_port
+        if send_thread:
+            self.sender = SendWorker(f"sender {port_name_relay}")
+            self.sender.start()
+            device, relay = QueuedPort(device, self.sender), QueuedPort(relay, self.sender)
+        # Sends, LED writes and input latency are only counted with `instrument`
+        self.instrument = instrument
+        self.leds = LedBuffer(device, count=instrument)
+        # With immediate relaying, input is relayed straight from the MIDI input thread
+        # while the clock thread still relays timeline and action changes
+        self.immediate_relay = immediate_relay
+        self.relay = relay
+        self.relay_counter = None
+        if instrument:
+            self.relay = self.relay_counter = CountingPort(self.relay)
+        if immediate_relay:
+            self.relay = LockedPort(self.relay)
+        # MIDI clock messages skip the relay queue on purpose: they have to go out on time and
+        # carry no note state that could overtake anything queued
+        self.send_relay_clock = raw_sender(self.relay)
+        self.send_relay_now = self.send_relay_clock
+        self.relay_queue = None
+        if relay_budget:
+            self.relay = self.relay_queue = RelayQueue(self.relay, relay_budget, relay_capacity)
+            # Immediately relayed input writes out what is queued first, to keep the order
+            self.send_relay_now = self.relay_queue.send_now
+        self.send_relay = raw_sender(self.relay)
+        # Keyword arguments for `TouchStrip.configure_input`
+        self.strip_input = strip_input or {}
         self.port_in.callback = self.process_message
         self.timeline = None
-        self.data_cache = None
-        self.prev_tick = None
+        self.slice_index = -1
         self.grid = None
+        # Controls that need to be visited on the next tick, used as an ordered set
+        self.dirty = {}
+        self.visited = 0
+        # Input messages are queued by the MIDI callback thread and handled at the start
+        # of the next tick, so all control state is only ever touched by the clock thread
+        self.inbox = deque()
+        self.max_pending_inputs = max_pending_inputs
+        self.dropped_inputs = 0
+        # Drops already reported, and when, see `report_drops`
+        self.reported_drops = 0
+        self.last_drop_report = None
+        self.input_latency = LatencyStats()
+        # How many ticks were started, and an optional `InputRecorder.record` for each message taken in
+        self.ticks = 0
+        self.record = None
+        # Set by a `Reloader` thread, swapped in at the start of the next tick
+        self.pending_reload = None
+        self.reload_lock = threading.Lock()
+        # Timelines replaced by a reload, released by the `Reloader` thread
+        self.retired = deque()
+        # The palette the LED frames of our controls were compiled with
+        self.palette = PALETTE
+        # Started with the first timeline that has animations
+        self.animator = None
+        self.animation_lookahead = animation_lookahead
         self.reset_grid()
 
     def shutdown(self):
@@ -572,111 +2861,456 @@ class MaschineJam(Tickable):
             button.reset()
             button.tick(0)
 
-        self.port_out.close()
+        if self.animator:
+            self.animator.stop()
+        if self.timeline:
+            self.timeline.release()
+        # Whatever the `Reloader` did not get to, it is stopped by now
+        while self.retired:
+            self.retired.popleft().release()
+        if self.pending_reload and self.pending_reload[0]:
+            self.pending_reload[0].release()
+        self.pending_reload = None
         self.port_in.close()
-        self.relay_port.close()
+        self.leds.flush()
+        # The resets above must reach the send thread before it stops
+        if self.relay_queue:
+            self.relay_queue.flush()
+        if self.sender:
+            self.sender.stop()
+        self.leds.close()
+        self.relay.close()
+
+    def stats(self):
+        return {
+            "visited": self.visited,
+            "device_sent": self.leds.sent if self.instrument else None,
+            "device_dropped": self.leds.dropped if self.instrument else None,
+            "relay_sent": self.relay_counter.sent if self.relay_counter else None,
+            "input_latency": self.input_latency.summary() if self.instrument else None,
+            "dropped_inputs": self.dropped_inputs,
+            "send_backlog": self.sender.max_backlog if self.sender else None,
+            "animation_misses": self.animator.misses if self.animator else None,
+            "relay_backlog": self.relay_queue.max_backlog if self.relay_queue else None,
+            "relay_stalls": self.relay_queue.stalls if self.relay_queue else None,
+            "relay_overflows": self.relay_queue.overflows if self.relay_queue else None,
+            "timeline_misses": getattr(self.timeline, "misses", None),
+        }
 
     def activate_timeline(self, timeline):
+        # Devices can share a timeline, it is closed when the last of them lets go of it
+        timeline.acquire()
+        if self.timeline:
+            self.timeline.release()
         self.timeline = timeline
+        self.slice_index = -1
+        self.start_animator()
+
+    def start_animator(self):
+        if self.animator is None and self.timeline and self.timeline.animations:
+            self.animator = Animator(self, self.animation_lookahead)
 
     def reset_grid(self):
-        self.grid = {i: Button(device_port=self.port_out, relay_port=self.relay_port, note=i)
+        self.grid = {i: Button(device_port=self.leds, relay_port=self.relay, note=i)
                      for i in range(64)}
-        self.touch_strips = {i + 48: TouchStrip(device_port=self.port_out, relay_port=self.relay_port, note=48 + i)
+        self.touch_strips = {i + 48: TouchStrip(device_port=self.leds, relay_port=self.relay, note=48 + i)
                              for i in range(8)}
-        self.special_buttons = {i: CCButton(device_port=self.port_out, relay_port=self.relay_port, note=i)
+        for strip in self.touch_strips.values():
+            strip.configure_input(**self.strip_input)
+        self.special_buttons = {i: CCButton(device_port=self.leds, relay_port=self.relay, note=i)
                                 for i in range(16)}
 
-        self.grid[63].led_state["active"] = LedState("mint", "bright")
-        self.grid[63].led_state["inactive"] = LedState("mint", "dim")
+        self.grid[63].configure(LedState("mint", "bright"), LedState("mint", "dim"))
 
         self.special_buttons[8].action = ClockToggleAction()
         self.special_buttons[9].action = ClockResetAction()
         self.special_buttons[10].action = ClockRewindAction(50)
         self.special_buttons[11].action = ClockForwardAction(50)
 
+        self.dirty = {}
+        for control in self.controls():
+            self.mark_dirty(control)
+
+    def controls(self):
+        yield from self.grid.values()
+        yield from self.special_buttons.values()
+        yield from self.touch_strips.values()
+
+    def mark_dirty(self, control):
+        self.dirty[control] = None
+
     def process_message(self, message):
+        """Queues an input message, called on the MIDI input thread.
+
+        The inbox holds at most `max_pending_inputs` messages, anything arriving while it
+        is full is dropped, counted in `dropped_inputs` and reported by the next tick.
+        """
+        timestamp = time.perf_counter_ns()
+        if len(self.inbox) >= self.max_pending_inputs:
+            self.dropped_inputs += 1
+            if self.record:
+                self.record(timestamp, message, dropped=True)
+            return
+
+        relayed = False
+        if self.immediate_relay:
+            control = self.control_for(message, warn=False)
+            # Messages without a control are still queued, so they are handled (and warned
+            # about) and recorded the same as without immediate relaying
+            state = control.input_state(message) if control is not None else None
+            if state is not None:
+                for frame in control.relay_frames(state):
+                    self.send_relay_now(frame)
+                relayed = True
+
+        self.inbox.append((timestamp, message, relayed))
+
+    def report_drops(self):
+        """Warns about input dropped since the last warning, at most once a second."""
+        now = time.perf_counter_ns()
+        if self.last_drop_report is not None and now - self.last_drop_report < 1e9:
+            return
+        dropped = self.dropped_inputs
+        print(colored("Warning:", "yellow"), f"Dropped {dropped - self.reported_drops} input messages from "
+                                             f"{self.port_in.name}, {self.max_pending_inputs} were already pending")
+        self.reported_drops = dropped
+        self.last_drop_report = now
+
+    def control_for(self, message, warn=True):
         if message.type == "note_on":
-            if 0 <= message.note <= 64:
-                self.grid[message.note].update(message)
-            else:
-                print("unhandled message", message)
+            control = self.grid.get(message.note)
         elif message.type == "control_change":
-            if 0 <= message.control <= 16:
-                self.special_buttons[message.control].update(message)
-            elif 48 <= message.control <= 111:
-                self.touch_strips[message.control].update(message)
+            control = self.special_buttons.get(message.control) or self.touch_strips.get(message.control)
+        else:
+            return None
+        if control is None and warn:
+            print("unhandled message", message)
+        return control
+
+    def control_for_note(self, note):
+        """Returns the control a timeline note key (`12` or `"cc3"`) refers to."""
+        if isinstance(note, int):
+            return self.grid.get(note)
+        if note.startswith("cc"):
+            return self.special_buttons.get(int(note.lstrip("cc")))
+        return None
+
+    def apply_changes(self, changes):
+        for note, old_spec, new_spec in changes:
+            control = self.control_for_note(note)
+            if control is None:
+                continue
+            # Sticky notes are only reset when nothing takes their place
+            if old_spec is not None and (new_spec is None or not old_spec["sticky"]):
+                control.reset()
+            if new_spec is not None:
+                control.configure(new_spec["led_state"]["active"], new_spec["led_state"]["inactive"],
+                                  new_spec["note_output"], new_spec["action"], new_spec["channel"],
+                                  frames=new_spec["frames"])
+            self.mark_dirty(control)
+
+    def handle_message(self, message, relayed=False):
+        control = self.control_for(message)
+        if control:
+            control.update(message, relayed=relayed)
+            self.mark_dirty(control)
+
+    def reload(self, timeline, palette, note_db):
+        """Queues recompiled tables to be swapped in between two ticks. Thread-safe.
+
+        `timeline` has to be acquired for this device already. Returns the reload it
+        replaced if that was not swapped in yet, whose timeline the caller has to release.
+        """
+        with self.reload_lock:
+            replaced = self.pending_reload
+            self.pending_reload = (timeline, palette, note_db)
+        return replaced
+
+    def apply_reload(self, tick_no, timeline, palette, note_db):
+        global PALETTE, NOTE_DB
+
+        # The tables are shared by all devices, whichever applies a reload first swaps them in
+        PALETTE, NOTE_DB = palette, note_db
+        if palette is not self.palette:
+            # Every LED color may have moved, the LED shadow drops the ones that did not. This
+            # goes around the ticks of the controls so nothing is relayed to the DAW again
+            for control in self.controls():
+                control.recompile()
+            self.palette = palette
+            self.repaint_animation()
+
+        if timeline is None:
+            return
+
+        # Only re-apply notes whose effective state differs between the old and new timeline
+        old_state = self.timeline.state_at(self.slice_index) if self.timeline else {}
+        index = timeline.index_at(tick_no)
+        new_state = timeline.state_at(index)
+        changes = []
+        recolored = 0
+        for note, old_spec, spec in Timeline.changes_between(old_state, new_state, Timeline.equivalent):
+            control = self.control_for_note(note)
+            # Notes that only changed color, e.g. after a palette edit, are repainted without
+            # resetting them, so held pads stay held and nothing is relayed to the DAW again
+            if control is not None and old_spec is not None and spec is not None and spec["frames"] \
+                    and Timeline.relay_key(old_spec) == Timeline.relay_key(spec):
+                control.recolor(spec["led_state"]["active"], spec["led_state"]["inactive"], spec["frames"])
+                recolored += 1
             else:
-                print("unhandled message", message)
+                changes.append((note, old_spec, spec))
+        if recolored:
+            self.repaint_animation()
+        self.apply_changes(changes)
+        # Acquired by the `Reloader`, which also releases the old one, off the clock thread
+        if self.timeline:
+            self.retired.append(self.timeline)
+        self.timeline = timeline
+        self.slice_index = index
+        self.start_animator()
+        print(f"Reloaded {timeline.filename}, {len(changes)} notes changed, {recolored} recolored")
+
+    def repaint_animation(self):
+        """Paints the whole animation frame again on the next tick, over pads repainted behind its back."""
+        if self.animator:
+            self.animator.shown = None
 
     def tick(self, tick_no):
-        if self.timeline and not self.prev_tick == tick_no:
-            self.prev_tick = tick_no
-            data = self.timeline.get(tick_no)
-            if data:
-                if self.data_cache and not self.data_cache == data:
-                    # Reset buttons from the previous time slice
-                    for note, note_spec in self.data_cache.items():
-                        if note_spec["sticky"]:
-                            continue
-                        if isinstance(note, int):
-                            self.grid[note].reset()
-                        elif note.startswith("cc"):
-                            cc_note = int(note.lstrip("cc"))
-                            self.special_buttons[cc_note].reset()
-
-                self.data_cache = data
-
-                for note, spec in data.items():
-                    if isinstance(note, int):
-                        self.grid[note].led_state["active"] = spec["led_state"]["active"]
-                        self.grid[note].led_state["inactive"] = spec["led_state"]["inactive"]
-                        self.grid[note].note_output = spec["note_output"]
-                        self.grid[note].action = spec["action"]
-                        self.grid[note].channel = spec["channel"]
-                        self.grid[note].needs_tick = True
-                    elif note.startswith("cc"):
-                        cc_note = int(note.lstrip("cc"))
-                        self.special_buttons[cc_note].led_state["active"] = spec["led_state"]["active"]
-                        self.special_buttons[cc_note].led_state["inactive"] = spec["led_state"]["inactive"]
-                        self.special_buttons[cc_note].note_output = spec["note_output"]
-                        self.special_buttons[cc_note].action = spec["action"]
-                        self.special_buttons[cc_note].needs_tick = True
+        if self.pending_reload:
+            with self.reload_lock:
+                reload = self.pending_reload
+                self.pending_reload = None
+            self.apply_reload(tick_no, *reload)
+
+        self.ticks += 1
+        received = []
+        inbox = self.inbox
+        # Backpressure: only take as much input as the relay queue has room for, the rest
+        # waits in the inbox in order
+        budget = self.relay_queue.room() if self.relay_queue else len(inbox)
+        record = self.record
+        while inbox and budget:
+            timestamp, message, relayed = inbox.popleft()
+            self.handle_message(message, relayed)
+            received.append(timestamp)
+            if record:
+                record(timestamp, message)
+            budget -= 1
+        if inbox and self.relay_queue:
+            self.relay_queue.stalls += 1
+        if self.dropped_inputs != self.reported_drops:
+            self.report_drops()
+
+        if self.timeline:
+            # Looking the slice up by range means seeks and skipped ticks land on the right one
+            index = self.timeline.index_at(tick_no)
+            if index != self.slice_index:
+                self.apply_changes(self.timeline.diff(self.slice_index, index))
+                self.slice_index = index
 
         if not CLOCK.locked:
             if (tick_no // CLOCK.ppq) % 2 == 0:
                 if self.grid[63].state == ButtonState.INACTIVE:
                     self.grid[63].state = ButtonState.ACTIVE
                     self.grid[63].needs_tick = True
+                    self.mark_dirty(self.grid[63])
             elif self.grid[63].state == ButtonState.ACTIVE:
                 self.grid[63].state = ButtonState.INACTIVE
                 self.grid[63].needs_tick = True
-
-        for button in self.grid.values():
-            button.tick(tick_no)
-
-        for button in self.special_buttons.values():
-            button.tick(tick_no)
-
-        for strip in self.touch_strips.values():
-            strip.tick(tick_no)
+                self.mark_dirty(self.grid[63])
+
+        # Only visit controls that were marked dirty. Each one is removed before it is
+        # ticked, so a control marked again while rendering is picked up on the next tick,
+        # as is one whose tick returns True because it has more to send.
+        dirty = list(self.dirty)
+        for control in dirty:
+            self.dirty.pop(control, None)
+            if control.tick(tick_no):
+                self.mark_dirty(control)
+        self.visited = len(dirty)
+
+        if self.animator:
+            self.animator.paint(tick_no, dirty)
+
+        self.leds.flush()
+        if self.relay_queue:
+            self.relay_queue.drain()
+
+        if received and self.instrument:
+            now = time.perf_counter_ns()
+            for timestamp in received:
+                self.input_latency.record(now - timestamp)
+
+
+def render(timeline, filename, ticks=None):
+    """Renders a timeline offline against a mock backend, writing every message sent to `filename`."""
+    if ticks is None:
+        # Play until one bar after the last slice or animation change
+        last = max([*timeline.ticks[-1:], *timeline.animation_ticks[-1:]], default=0) if timeline else 0
+        ticks = last + 4 * CLOCK.ppq
+
+    start = time.perf_counter()
+    with open(filename, "w") as f:
+        writer = RenderWriter(f, CLOCK)
+        # Animation frames are rendered on the spot, the lookahead thread could not keep up anyway
+        jam = MaschineJam("device", "device", "relay", animation_lookahead=0,
+                          backend=MockBackend(writer))
+        if timeline:
+            jam.activate_timeline(timeline)
+        CLOCK.register(jam)
+        CLOCK.unlock()
+        CLOCK.run_offline(ticks)
+        jam.reset_grid()
+        CLOCK.tick()
+        jam.shutdown()
+    elapsed = time.perf_counter() - start
+
+    print(f"Rendered {ticks} ticks ({CLOCK.ticks_to_seconds(ticks):.1f}s of playback) "
+          f"and {writer.messages} messages to {filename} in {elapsed:.3f}s")
+
+
+def replay(recording, timelines, filename, realtime=False, **options):
+    """Replays a recorded input session against mock devices, writing every message sent to `filename`.
+
+    `timelines` holds the timeline (or None) for each recorded device, `options` are passed on to them.
+    """
+    start = time.perf_counter()
+    with open(filename, "w") as f:
+        writer = RenderWriter(f, CLOCK)
+        backend = MockBackend(writer)
+        jams = []
+        for i in range(recording.devices):
+            suffix = f" {i + 1}" if i else ""
+            # Rendering animations ahead only pays off when ticks are spaced out like live
+            jam = MaschineJam(f"device{suffix}", f"device{suffix}", f"relay{suffix}",
+                              animation_lookahead=8 if realtime else 0, backend=backend, **options)
+            if timelines[i]:
+                jam.activate_timeline(timelines[i])
+            jams.append(jam)
+        recording.attach([jam.port_in for jam in jams])
+
+        # Play until one bar after the last message
+        tail = 4 * CLOCK.ppq
+        if realtime:
+            for jam in jams:
+                CLOCK.register(jam)
+            # Hand the GIL back to the clock thread quickly, as with several devices
+            sys.setswitchinterval(0.0005)
+            feeder = threading.Thread(target=recording.feed, name="replay", daemon=True)
+            feeder.start()
+            while feeder.is_alive():
+                CLOCK.once()
+            for _ in range(tail):
+                CLOCK.once()
+        else:
+            CLOCK.register(recording)
+            for jam in jams:
+                CLOCK.register(jam)
+            CLOCK.run_offline(recording.last_tick + 1 + tail)
+        for jam in jams:
+            jam.reset_grid()
+        CLOCK.tick()
+        for jam in jams:
+            jam.shutdown()
+    elapsed = time.perf_counter() - start
+
+    print(f"Replayed {len(recording.records)} input messages from {recording.filename} "
+          f"{'in real time' if realtime else 'as fast as possible'} in {elapsed:.3f}s, "
+          f"{writer.messages} messages sent to {filename}")
+    if CLOCK.metrics:
+        print(f"Tick time: {CLOCK.metrics.tick_time}")
+    if realtime and CLOCK.metrics:
+        print(f"Tick lateness: {CLOCK.jitter}")
+    if recording.dropped:
+        print(f"{recording.dropped} input messages were dropped while recording"
+              f"{', left out' if not realtime else ''}")
+    for i, jam in enumerate(jams):
+        device = f" (device {i + 1})" if len(jams) > 1 else ""
+        if jam.instrument:
+            print(f"Input to LED latency{device}: {jam.input_latency}")
+        if jam.dropped_inputs:
+            print(colored("Warning:", "yellow"), f"Dropped {jam.dropped_inputs} input messages{device}")
+
+
+def positive_int(value):
+    """Parses a command line count that has to be at least 1."""
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError(f"must be at least 1, got {number}")
+    return number
 
 
 def main(args):
     global CLOCK, NOTE_DB, PALETTE
 
-    CLOCK = Clock(bpm=args.bpm, ppq=args.ppq, locked=True)
-
-    NOTE_DB = NoteDB(args.notes_file)
-
-    PALETTE = Palette(args.palette_file)
-
-    timeline = None
-    if args.timeline_file:
-        timeline = Timeline(args.timeline_file)
+    recording = None
+    if args.replay_file:
+        recording = InputReplay(args.replay_file)
+        header = recording.header
+        # Replay at the tempo and from the transport state the session was recorded with
+        args.bpm, args.ppq = header["bpm"], header["ppq"]
+        # One entry per recorded device, None for those that played without a timeline
+        args.timeline_files = args.timeline_files or list(header["timelines"])
+        if header.get("clock_in") or args.clock_in:
+            print(colored("Warning:", "yellow"), "The external clock is not part of the recording, "
+                                                 f"replaying at {args.bpm} BPM")
+            args.clock_in = None
+
+    if args.clock_in:
+        # --bpm stays the nominal tempo, natural language timeline keys are converted with it
+        CLOCK = ExternalClock(bpm=args.bpm, ppq=args.ppq, late_policy=args.late_policy, spin=args.spin / 1000)
     else:
+        locked = recording.header["locked"] if recording else True
+        CLOCK = Clock(bpm=args.bpm, ppq=args.ppq, locked=locked, late_policy=args.late_policy, spin=args.spin / 1000)
+
+    profiler = None
+    if args.profile or args.tick_budget or args.trace_file:
+        profiler = Profiler(CLOCK, budget=args.tick_budget / 1000 if args.tick_budget else None,
+                            trace_file=args.trace_file)
+        CLOCK.profile(profiler)
+
+    NOTE_DB = NoteDB(args.notes_file, cache=args.cache)
+
+    PALETTE = Palette(args.palette_file, cache=args.cache)
+
+    # Devices sharing a timeline file share the compiled timeline
+    timeline_class = StreamingTimeline if args.stream else Timeline
+    timelines = {}
+    for timeline_file in args.timeline_files or ():
+        if timeline_file is not None and timeline_file not in timelines:
+            timelines[timeline_file] = timeline_class(timeline_file, cache=args.cache)
+    if not timelines:
         print(colored("Warning:", "yellow"), "No timeline file specified, no responses will be generated")
 
+    strip_input = {"rate": args.strip_rate, "deadband": args.strip_deadband, "interpolate": args.strip_interpolate}
+    options = dict(immediate_relay=args.immediate_relay, instrument=args.metrics, relay_budget=args.relay_budget,
+                   relay_capacity=args.relay_capacity, strip_input=strip_input)
+
+    if recording:
+        timeline_files = args.timeline_files or [None]
+        device_timelines = [timelines.get(timeline_files[min(i, len(timeline_files) - 1)])
+                            for i in range(recording.devices)]
+        if args.metrics:
+            CLOCK.instrument(Metrics(CLOCK, report_interval=None, json_file=args.metrics_json))
+        replay(recording, device_timelines, args.render_file or os.devnull, realtime=args.replay_realtime,
+               **options)
+        if CLOCK.metrics and args.metrics_json:
+            CLOCK.metrics.dump(args.metrics_json)
+        if profiler:
+            profiler.close()
+            profiler.report()
+        return
+
+    if args.render_file:
+        if len(timelines) > 1:
+            print(colored("Warning:", "yellow"), "Only rendering the first timeline")
+        render(next(iter(timelines.values()), None), args.render_file, args.render_ticks)
+        if profiler:
+            profiler.close()
+            profiler.report()
+        return
+
+    import mido
+
     maschine_jam_inputs = [item for item in mido.get_input_names() if "Maschine Jam" in item]
     maschine_jam_outputs = [item for item in mido.get_output_names() if "Maschine Jam" in item]
 
@@ -684,37 +3318,217 @@ def main(args):
         print(colored("Error:", "red"), "No Maschine Jam controller found, is it plugged in?")
         sys.exit(1)
 
-    jam = MaschineJam(maschine_jam_inputs[0], maschine_jam_outputs[0], args.port_name_relay)
-
-    if timeline:
-        jam.activate_timeline(timeline)
-
-    CLOCK.register(jam)
+    clock_port = None
+    if args.clock_in:
+        clock_inputs = [item for item in mido.get_input_names() if args.clock_in in item]
+        if not clock_inputs:
+            print(colored("Error:", "red"), f"No MIDI input matching {args.clock_in!r} found to follow the clock of")
+            sys.exit(1)
+        clock_port = mido.open_input(clock_inputs[0])
+        CLOCK.attach(clock_port)
+        print(f"Following the MIDI clock from {clock_inputs[0]}")
+
+    # Every connected device is driven by the same clock. The n-th device plays the n-th timeline and
+    # relays to the n-th relay port, devices past the end of either list get the last timeline and
+    # a numbered relay port.
+    port_names = list(zip(maschine_jam_inputs, maschine_jam_outputs))
+    relay_names = args.port_names_relay or ["MJAM Out"]
+    devices = []
+    for i, (port_name_in, port_name_out) in enumerate(port_names):
+        port_name_relay = relay_names[i] if i < len(relay_names) else f"{relay_names[-1]} {i + 1}"
+        # With more than one device, each writes from a thread of its own
+        jam = MaschineJam(port_name_in, port_name_out, port_name_relay, send_thread=len(port_names) > 1, **options)
+        timeline_file = None
+        if args.timeline_files:
+            timeline_file = args.timeline_files[min(i, len(args.timeline_files) - 1)]
+            jam.activate_timeline(timelines[timeline_file])
+        devices.append((jam, timeline_file))
+        if len(port_names) > 1:
+            print(f"{port_name_in}: relaying to {port_name_relay}, playing {timeline_file}")
+    jams = [jam for jam, _ in devices]
+    if len(jams) > 1 or args.stream:
+        # The send and prefetch threads hand the GIL back and forth with the clock thread a lot,
+        # the default 5 ms switch interval would hold up ticks behind them
+        sys.setswitchinterval(0.0005)
+
+    clock_output = None
+    if args.clock_out is not None:
+        if CLOCK.ppq % ClockOutput.MIDI_PPQ:
+            print(colored("Warning:", "yellow"), "MIDI clock output is uneven unless --ppq is a multiple of 24")
+        if args.clock_out:
+            port = mido.open_output(args.clock_out, virtual=True)
+            clock_output = ClockOutput(CLOCK, raw_sender(port), port)
+        else:
+            clock_output = ClockOutput(CLOCK, jams[0].send_relay_clock)
+        CLOCK.register(clock_output, name="clock output")
+
+    for jam in jams:
+        CLOCK.register(jam, name=jam.port_in.name)
+
+    if args.metrics:
+        CLOCK.instrument(Metrics(CLOCK, report_interval=args.metrics_interval, json_file=args.metrics_json))
+
+    recorder = None
+    if args.record_file:
+        recorder = InputRecorder(args.record_file, CLOCK, header={
+            "bpm": CLOCK.bpm, "ppq": CLOCK.ppq, "locked": CLOCK.locked, "clock_in": bool(args.clock_in),
+            "timelines": [timeline_file for _, timeline_file in devices],
+            "devices": [jam.port_in.name for jam in jams],
+        })
+        recorder.attach(jams)
+        # Registered after the devices, it writes out what they took in on each tick
+        CLOCK.register(recorder)
+        print(f"Recording input to {args.record_file}")
+
+    reloader = None
+    if args.watch:
+        reloader = Reloader(devices, args.palette_file, args.notes_file, cache=args.cache,
+                            timeline_class=timeline_class)
+        reloader.start()
+
+    runner = clock_thread = None
+    if args.asyncio:
+        runner = AsyncRunner(CLOCK, priority=args.realtime_priority)
+        for jam in jams:
+            runner.bridge(jam.port_in, jam.process_message)
+        if clock_port:
+            runner.bridge(clock_port, CLOCK.receive)
+    else:
+        clock_thread = ClockThread(CLOCK, priority=args.realtime_priority)
+        clock_thread.start()
 
     try:
-        while True:
-            CLOCK.once()
+        if runner:
+            import asyncio
+            asyncio.run(runner.run())
+        else:
+            while clock_thread.is_alive():
+                clock_thread.join(0.5)
     except KeyboardInterrupt:
+        pass
+    finally:
+        if reloader:
+            reloader.stop()
+        if clock_thread:
+            clock_thread.stop()
+        if clock_port:
+            clock_port.close()
         print("\nClosed")
-        jam.reset_grid()
+        for jam in jams:
+            jam.reset_grid()
         CLOCK.tick()
-        jam.shutdown()
+        for jam in jams:
+            jam.shutdown()
+        if clock_output:
+            clock_output.close()
+        if recorder:
+            recorder.close()
+            print(f"Recorded {recorder.records} input messages to {args.record_file}")
+        if CLOCK.metrics:
+            print(f"Tick lateness: {CLOCK.jitter}")
+        if clock_port:
+            print(f"External clock: {CLOCK.tempo:.2f} BPM, incoming jitter {CLOCK.sync_error}")
+        if clock_output and CLOCK.metrics:
+            print(f"Clock output: lateness {clock_output.lateness}, interval error {clock_output.interval_error}")
+        for jam in jams:
+            device = f" ({jam.port_in.name})" if len(jams) > 1 else ""
+            if jam.instrument:
+                print(f"Input to LED latency{device}: {jam.input_latency}")
+            if jam.dropped_inputs:
+                print(colored("Warning:", "yellow"),
+                      f"Dropped {jam.dropped_inputs} input messages{device}, the input queue was full")
+            if jam.relay_queue and jam.relay_queue.overflows:
+                print(colored("Warning:", "yellow"),
+                      f"Relayed {jam.relay_queue.overflows} frames{device} over the relay budget, "
+                      f"the relay queue was full")
+        if CLOCK.late_ticks:
+            print(f"Fell behind {CLOCK.late_ticks} times, skipped {CLOCK.skipped_ticks} ticks")
+        if CLOCK.metrics and args.metrics_json:
+            CLOCK.metrics.dump(args.metrics_json)
+        if profiler:
+            profiler.close()
+            profiler.report()
 
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
-    parser.add_argument("-t", "--timeline", type=str, dest="timeline_file",
-                        metavar="file", help="(required) The file containing the timeline data")
+    parser.add_argument("-t", "--timeline", type=str, dest="timeline_files", action="append",
+                        metavar="file", help="(required) The file containing the timeline data, give it once per "
+                                             "device to play a different timeline on each connected device")
     parser.add_argument("-n", "--notes", type=str, dest="notes_file", default="notes.yaml",
                         metavar="file", help="The file containing notes data")
     parser.add_argument("-c", "--palette", type=str, dest="palette_file", default="palette.yaml",
                         metavar="file", help="The file containing color data for the device")
-    parser.add_argument("-r", "--relay-port", type=str, dest="port_name_relay", default="MJAM Out",
-                        metavar="name", help="The name of the port to relay MIDI messages to")
+    parser.add_argument("-r", "--relay-port", type=str, dest="port_names_relay", action="append",
+                        metavar="name", help="The name of the port to relay MIDI messages to (default: MJAM Out), "
+                                             "give it once per device to name each device's relay port")
     parser.add_argument("-b", "--bpm", type=int, dest="bpm", default=120,
                         metavar="number", help="Beats per Minute")
     parser.add_argument("-p", "--ppq", type=int, dest="ppq", default=24,
                         metavar="number", help="Pulses per Quarter Note")
+    parser.add_argument("--late-policy", type=str, dest="late_policy", default="catch_up",
+                        choices=Clock.LATE_POLICIES,
+                        help="What to do when the clock falls behind by a whole tick: play the missed ticks "
+                             "back-to-back, skip them or shift all following ticks back")
+    parser.add_argument("--clock-in", type=str, dest="clock_in", default=None,
+                        metavar="name", help="Follow MIDI clock, start/stop and song position from the input port "
+                                             "containing this name instead of running from --bpm")
+    parser.add_argument("--clock-out", type=str, dest="clock_out", nargs="?", const="", default=None,
+                        metavar="name", help="Send MIDI clock, start/stop and song position, on the relay port or "
+                                             "on a new port with this name")
+    parser.add_argument("--spin", type=float, dest="spin", default=1.0,
+                        metavar="ms", help="How long before each tick to stop sleeping and busy-wait instead")
+    parser.add_argument("--realtime", type=int, dest="realtime_priority", nargs="?", const=10, default=None,
+                        metavar="priority", help="Run the clock thread with real-time (SCHED_FIFO) priority, Linux only")
+    parser.add_argument("--asyncio", action="store_true", dest="asyncio",
+                        help="Run the clock and MIDI input on an asyncio event loop instead of a clock thread")
+    parser.add_argument("--immediate-relay", action="store_true", dest="immediate_relay",
+                        help="Relay pad and button presses as soon as they arrive instead of on the next tick")
+    parser.add_argument("--strip-rate", type=positive_int, dest="strip_rate", default=None,
+                        metavar="values", help="Relay at most this many values per touch strip and tick, "
+                                               "the rest follow on later ticks")
+    parser.add_argument("--strip-deadband", type=int, dest="strip_deadband", default=0,
+                        metavar="steps", help="Skip touch strip changes smaller than this, except the last of a burst")
+    parser.add_argument("--strip-interpolate", type=int, dest="strip_interpolate", default=0,
+                        metavar="steps", help="Fill in up to this many values between touch strip values further apart")
+    parser.add_argument("--relay-budget", type=positive_int, dest="relay_budget", default=None,
+                        metavar="frames", help="Queue relay sends and write at most this many per tick")
+    parser.add_argument("--relay-capacity", type=positive_int, dest="relay_capacity", default=1024,
+                        metavar="frames", help="Hold back input once this many relay sends are queued, "
+                             "and write out the oldest over the budget beyond it")
+    parser.add_argument("--no-metrics", action="store_false", dest="metrics",
+                        help="Disable collecting and reporting runtime statistics")
+    parser.add_argument("--metrics-interval", type=float, dest="metrics_interval", default=10,
+                        metavar="seconds", help="How often to print a statistics summary")
+    parser.add_argument("--metrics-json", type=str, dest="metrics_json", default=None,
+                        metavar="file", help="Also dump statistics as JSON to this file with every summary")
+    parser.add_argument("--profile", action="store_true", dest="profile",
+                        help="Time every object ticked by the clock and every action run, summarized on exit")
+    parser.add_argument("--tick-budget", type=float, dest="tick_budget", default=None,
+                        metavar="ms", help="Log ticks taking longer than this and what took the longest, "
+                                           "implies --profile")
+    parser.add_argument("--trace", type=str, dest="trace_file", default=None,
+                        metavar="file", help="Write every tick as Chrome trace events to this file, to open in "
+                                             "chrome://tracing or Perfetto, implies --profile")
+    parser.add_argument("--render", type=str, dest="render_file", default=None,
+                        metavar="file", help="Render the timeline offline (no device needed) and write every "
+                                             "message sent to this file")
+    parser.add_argument("--render-ticks", type=int, dest="render_ticks", default=None,
+                        metavar="number", help="How many ticks to render, defaults to one bar past the last slice")
+    parser.add_argument("--record", type=str, dest="record_file", default=None,
+                        metavar="file", help="Record every input message to this file, to replay the session later")
+    parser.add_argument("--replay", type=str, dest="replay_file", default=None,
+                        metavar="file", help="Replay a recorded session against mock devices (no device needed), "
+                                             "writing every message sent to the --render file")
+    parser.add_argument("--replay-realtime", action="store_true", dest="replay_realtime",
+                        help="Replay at the pace the session was recorded at instead of as fast as possible")
+    parser.add_argument("-w", "--watch", action="store_true", dest="watch",
+                        help="Reload the timeline, palette and notes files when they change")
+    parser.add_argument("--stream", action="store_true", dest="stream",
+                        help="Stream the timeline from a compiled file, only keeping the part around the playhead "
+                             "in memory, for very long shows. Slices have to be in tick order")
+    parser.add_argument("--no-cache", action="store_false", dest="cache",
+                        help="Always parse the timeline, palette and notes from scratch instead of using the compiled cache")
     args = parser.parse_args()
 
     main(args)